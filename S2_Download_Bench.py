@@ -0,0 +1,270 @@
+#!/usr/local/bin/python3
+import sys, os
+from time import strptime
+import xml.etree.ElementTree as ET
+import argparse
+import time, tracemalloc, tempfile, shutil
+
+import S2_Download_FromList as S2
+import S2_Download_MockHub as Mock
+
+#----------------------------------------------------------------------------------------------------
+# Usage
+#----------------------------------------------------------------------------------------------------
+__version__=1.0
+parser = argparse.ArgumentParser(description='''              Benchmark of S2_Download_FromList parsers
+    Time and peak memory of the answer parsers (OpenSearch page, product
+Xml files, meta4 cart) on the sample answers of the Samples folder,
+streamed parsers of the script against the former DOM ones.
+    With -flow, the whole script pipeline (list reading, queries,
+downloads) runs on tile lists of the given sizes against the local mock
+hub (S2_Download_MockHub.py), no network nor account needed.
+
+**************************************************************************
+                             Tasks:
+Python 3 - Version %.1f
+- Read the samples, the search page and the meta4 cart are repeated to
+  the wanted size (-rows, -products)
+- Run each parser -runs times
+- Print time per call and peak memory
+    OR (-flow 10 100 1000)
+- Start the mock hub on localhost with -latency, -bandwidth, -errors and
+  build the tile index from its grid
+- For each list size, write the tile list (one product per tile, -bands)
+  and run it with -jobs downloads (-hostjobs per host), band windows and
+  reduced levels with -window -reduce (mock bands cover 31TFL)
+- Print wall time, tiles done, volume, throughput, retries, hub requests
+  and peak memory (Python allocations)
+**************************************************************************
+
+'''% __version__,
+formatter_class=argparse.RawDescriptionHelpFormatter)
+
+#----------------------------------------------------------------------------------------------------
+# Hard arguments
+#----------------------------------------------------------------------------------------------------
+pathSample=os.path.join(os.path.dirname(os.path.abspath(__file__)),'Samples')
+
+#----------------------------------------------------------------------------------------------------
+# DOM parsers (S2_Download_FromList 2.4)
+#----------------------------------------------------------------------------------------------------
+def DomParseOSQuery(content,lstTile,date):
+    dicFound={}
+    root=ET.fromstring(content)
+    noise=root.tag.split('}')[0]+'}'
+    
+    nbTotal=0
+    for elem in root:
+        if elem.tag.endswith('}totalResults'): nbTotal=int(elem.text)
+    
+    for entry in root.findall(noise+'entry'):
+        title=entry.find(noise+'title').text
+        if not title.startswith('S2'): continue
+        wordsTitle=title.split('_')
+        
+        #match query answer (Tile)
+        if not wordsTitle[5][1:] in lstTile : continue
+        #match query answer (Date)
+        if not wordsTitle[2][:8]==time.strftime('%Y%m%d',date) : continue
+        
+        id=entry.find(noise+'id').text
+        url=entry.find(noise+'link').attrib['href']
+        dicFound[wordsTitle[5][1:]]=[title,id,url]
+    
+    return dicFound,nbTotal
+
+def DomReadS2XML(path,level):
+    tree=ET.parse(path)
+    root=tree.getroot()
+    
+    if level=='S2MSI1C':
+        dico=dict([(elem.text.split('_')[-1],elem.text+'.jp2') for elem in root.iter('IMAGE_FILE')])
+    elif level=='S2MSI2A':
+        dico={}
+        for elem in root.iter('IMAGE_FILE'):
+            key=elem.text.split('_')[-2]
+            if key in dico: continue
+            dico[key]=elem.text+'.jp2'
+    
+    return dico
+
+def DomReadMeta4(pathFile,bands):
+    tree=ET.parse(pathFile)
+    root=tree.getroot()
+    noise=root.tag.replace('}metalink','}')
+    
+    lst=[]
+    for prod in root:
+        title=prod.attrib['name'].replace('.zip','')
+        md5=prod.find(noise+'hash').text
+        urlOD=prod.find(noise+'url').text.replace('dhus','apihub')
+        ident=urlOD.split("Products('")[-1].split("')")[0]
+        
+        words=title.split('_')
+        tile=words[5][1:]
+        date=strptime(words[2][:8], '%Y%m%d')
+        level='S2MSI'+words[1][-2:]
+        
+        lst.append([tile,date,level,bands,os.curdir,title,ident,urlOD,md5])
+    return lst
+
+#----------------------------------------------------------------------------------------------------
+# Benchmark
+#----------------------------------------------------------------------------------------------------
+def Repeat(text,tagOpen,tagClose,nb):
+    '''Sample text with its first-to-last tagOpen...tagClose elements repeated up to nb elements'''
+    start=text.index(tagOpen)
+    end=text.rindex(tagClose)+len(tagClose)
+    lstElem=[elem+tagClose for elem in text[start:end].split(tagClose)[:-1]]
+    return text[:start]+''.join(lstElem[k%len(lstElem)] for k in range(nb))+text[end:]
+
+def Measure(fct,args,nbRun):
+    '''Seconds per call and peak memory (bytes) of fct(*args)'''
+    tracemalloc.start()
+    fct(*args)
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    start=time.perf_counter()
+    for k in range(nbRun): fct(*args)
+    return (time.perf_counter()-start)/nbRun,peak
+
+def RunFlow(hub,pathGrid,repTemp,nbTile,bands,nbJobs,nbPerHost,window=None,reduce=0):
+    '''
+    Tile list of nbTile rows written, read, queried and downloaded from the 
+    mock hub by the script pipeline. Returns wall time (s), tiles done, 
+    bytes, retries and peak memory (bytes), outputs are removed after.
+    '''
+    repOut=os.path.join(repTemp,'out')
+    os.mkdir(repOut)
+    pathList=os.path.join(repTemp,'list%i.txt'% nbTile)
+    with open(pathList,'w') as fileOut:
+        for nameTile in hub.lstTile[:nbTile]: fileOut.write('T%s ; 20181007 ; L1C ; %s ; %s\n'% (nameTile,bands,repOut))
+    
+    stats=S2.RunStats()
+    pool=S2.DownloadPool(S2.TransportHttp(['bench','bench']),nbJobs,nbPerHost,stats)
+    tracemalloc.start()
+    start=time.perf_counter()
+    with open(pathList) as fileIn:
+        dicCount,stat=S2.RunPipeline(S2.IterListTile(fileIn),pool,pathGrid,window=window,reduce=reduce,planner=S2.DiskPlanner())
+    wall=time.perf_counter()-start
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    pool.Shutdown()
+    
+    shutil.rmtree(repOut)
+    os.remove(pathList)
+    if dicCount['error']: raise dicCount['error']
+    return wall,stat,stats.nbByte,stats.nbRetry,peak
+
+#==========================================================
+#main
+#----------------------------------------------------------
+if __name__ == "__main__":
+    try:
+        parser.add_argument('-rows',type=int,default=S2.nbRowsQuery,help='Entries of the search page (default %i)'% S2.nbRowsQuery)
+        
+        parser.add_argument('-products',type=int,default=5000,help='Products of the meta4 cart (default 5000)')
+        
+        parser.add_argument('-runs',type=int,default=20,help='Calls per parser (default 20)')
+        
+        parser.add_argument('-flow',type=int,nargs='+',metavar='TILES',help='Run the pipeline against the mock hub on lists of TILES tiles instead (e.g. 10 100 1000)')
+        
+        parser.add_argument('-bands',default='B02B03B04',help='Bands of the -flow lists, prod for whole products (default B02B03B04)')
+        
+        parser.add_argument('-size',type=int,default=128,help='Band payload of the mock hub in KiB, whole products are 4 times bigger (default 128)')
+        
+        parser.add_argument('-latency',type=float,default=0.05,help='Seconds before each mock hub answer (default 0.05)')
+        
+        parser.add_argument('-bandwidth',type=float,default=0,help='Mock hub MiB/s per connection, 0 for no limit (default 0)')
+        
+        parser.add_argument('-errors',type=float,default=0.0,help='Share of the mock hub answers 429/503/500 (default 0)')
+        
+        parser.add_argument('-window',type=float,nargs=4,metavar=('LONMIN','LATMIN','LONMAX','LATMAX'),help='Band window of the -flow lists, inside 31TFL for the mock bands (e.g. 4.5 44.5 4.7 44.7)')
+        
+        parser.add_argument('-reduce',type=int,default=0,help='Resolution levels dropped from the -flow bands (default 0)')
+        
+        parser.add_argument('-jobs',type=int,default=4,help='Number of simultaneous downloads (default 4)')
+        
+        parser.add_argument('-hostjobs',type=int,default=2,help='Maximum simultaneous downloads on the mock hub (default 2)')
+        
+        args = parser.parse_args()
+        if not os.path.isdir(pathSample): raise RuntimeError("Sample folder did not find : %s"% pathSample)
+        
+        #----------------------------------------------------------------------------------------------------
+        # Pipeline against the mock hub
+        #----------------------------------------------------------------------------------------------------
+        if args.flow:
+            hub=Mock.MockHub(max(args.flow),args.latency,args.bandwidth*1048576,args.errors,args.size*1024,args.size*4096).Start()
+            S2.urlOS,S2.urlGrid=hub.urlOS,hub.urlGrid
+            repTemp=tempfile.mkdtemp()
+            pathGrid=os.path.join(repTemp,'grid.sqlite')
+            stdout=sys.stdout
+            sys.stdout=open(os.devnull,'w')
+            try:
+                grid=S2.TileGrid(pathGrid)
+                grid.Build(hub.urlGrid)
+                grid.Close()
+                lstRes=[]
+                for nbTile in args.flow:
+                    dicBefore=dict(hub.counts)
+                    lstRes.append((nbTile,)+RunFlow(hub,pathGrid,repTemp,nbTile,args.bands,args.jobs,args.hostjobs,args.window,args.reduce)+(hub.counts['request']-dicBefore['request'],hub.counts['error']-dicBefore['error']))
+            finally:
+                sys.stdout.close()
+                sys.stdout=stdout
+                hub.Stop()
+                shutil.rmtree(repTemp)
+            
+            print('Mock hub: latency %.3f s, bandwidth %s, errors %.1f%%, bands %s%s%s, %i jobs (%i per host)'% (args.latency,'%.1f MiB/s'% args.bandwidth if args.bandwidth else 'unlimited',args.errors*100,args.bands,' window %s'% args.window if args.window else '',' reduce %i'% args.reduce if args.reduce else '',args.jobs,args.hostjobs))
+            print('%8s %8s %10s %10s %10s %8s %9s %8s %10s'% ('Tiles','Done','Wall s','MiB','MiB/s','Tiles/s','Requests','Retries','Peak MiB'))
+            for nbTile,wall,stat,nbByte,nbRetry,peak,nbRequest,nbError in lstRes:
+                print('%8i %8i %10.2f %10.1f %10.2f %8.1f %9i %8i %10.1f'% (nbTile,stat,wall,nbByte/1048576,nbByte/1048576/wall,stat/wall,nbRequest,nbRetry,peak/1048576))
+            sys.exit(0)
+        
+        #----------------------------------------------------------------------------------------------------
+        # Samples
+        #----------------------------------------------------------------------------------------------------
+        textPage=open(os.path.join(pathSample,'OpenSearch_Page.xml')).read()
+        content=Repeat(textPage,'<entry>','</entry>',args.rows).encode()
+        root=ET.fromstring(content)
+        noise=root.tag.split('}')[0]+'}'
+        lstTitle=[entry.find(noise+'title').text for entry in root.findall(noise+'entry')]
+        # products of the first sensing date, first one and all the page
+        date=strptime(lstTitle[0].split('_')[2][:8],'%Y%m%d')
+        lstTileDate=[title.split('_')[5][1:] for title in lstTitle if title.split('_')[2][:8]==lstTitle[0].split('_')[2][:8]]
+        
+        repTemp=tempfile.mkdtemp()
+        pathMeta4=os.path.join(repTemp,'products.meta4')
+        with open(pathMeta4,'w') as fileOut:
+            fileOut.write(Repeat(open(os.path.join(pathSample,'products.meta4')).read(),'<file ','</file>',args.products))
+        
+        lstCase=[('ParseOSQuery first tile',DomParseOSQuery,(content,lstTileDate[:1],date),S2.ParseOSQuery,(content,lstTileDate[:1],date)),
+            ('ParseOSQuery %i tiles'% len(lstTileDate),DomParseOSQuery,(content,lstTileDate,date),S2.ParseOSQuery,(content,lstTileDate,date)),
+            ('ReadS2XML L1C',DomReadS2XML,(os.path.join(pathSample,'MTD_MSIL1C.xml'),'S2MSI1C'),S2.ReadS2XML,(os.path.join(pathSample,'MTD_MSIL1C.xml'),'S2MSI1C')),
+            ('ReadS2XML L2A',DomReadS2XML,(os.path.join(pathSample,'MTD_MSIL2A.xml'),'S2MSI2A'),S2.ReadS2XML,(os.path.join(pathSample,'MTD_MSIL2A.xml'),'S2MSI2A')),
+            ('ReadMeta4 %i products'% args.products,DomReadMeta4,(pathMeta4,'prod'),S2.ReadMeta4,(pathMeta4,'prod')),]
+        
+        #----------------------------------------------------------------------------------------------------
+        # Runs
+        #----------------------------------------------------------------------------------------------------
+        print('%-28s %12s %12s %10s %10s %7s'% ('Parser','DOM ms','Stream ms','DOM KiB','Stream KiB','Speed'))
+        stdout=sys.stdout
+        for name,fctDom,argsDom,fctStream,argsStream in lstCase:
+            # the script parsers print the product level
+            sys.stdout=open(os.devnull,'w')
+            try:
+                timeDom,memDom=Measure(fctDom,argsDom,args.runs)
+                timeStream,memStream=Measure(fctStream,argsStream,args.runs)
+            finally:
+                sys.stdout.close()
+                sys.stdout=stdout
+            print('%-28s %12.3f %12.3f %10i %10i %6.1fx'% (name,timeDom*1e3,timeStream*1e3,memDom/1024,memStream/1024,timeDom/timeStream))
+        
+        os.remove(pathMeta4)
+        os.rmdir(repTemp)
+    
+    #----------------------------------------------------------------------------------------------------
+    # Exceptions
+    #----------------------------------------------------------------------------------------------------
+    except RuntimeError as msg:
+        print("\nERROR - ", msg)
@@ -3,7 +3,31 @@ import sys, os
 from time import strftime,strptime,localtime
 import xml.etree.ElementTree as ET
 import argparse
+import threading
+import subprocess, shutil, tempfile
+import multiprocessing
+import urllib.parse
+import http.client, ssl, base64, hashlib
+import sqlite3, json, time, io
+import struct, re, math, random
+import email.utils
+import csv
+from contextlib import contextmanager, nullcontext
+import queue
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+import zipfile
 from pprint import pprint
+try:
+    import numpy as np
+except ImportError:
+    # pure Python footprint matching
+    np=None
+try:
+    from osgeo import gdal
+except ImportError:
+    # no Cloud Optimised GeoTIFF conversion
+    gdal=None
 
 #----------------------------------------------------------------------------------------------------
 # Usage
@@ -28,7 +52,8 @@ to send 'aria2 -M cart.meta4' command.
 **************************************************************************
                              Tasks:
 Python 3 - Version %.1f
-- Search on computer a known Download Package through this list:
+- Use the in-process HTTP client (keep-alive connections pooled per host)
+  OR search on computer a known Download Package through this list (-dp):
        • Wget : https://www.gnu.org/software/wget/
        • cURL : https://curl.haxx.se/
        • Aria2 : https://aria2.github.io/manual/en/html/index.html
@@ -44,23 +69,54 @@ Python 3 - Version %.1f
     OR
   Read a '.meta4' file (then OpenSearchquery avoided, download in the current directory)
 
-- Get tile centroides from ESA kml (hard link)
-For each tiles
-- Get the product ID by OpenSearch query (On Scihub, tiles are referenced by Id name)
-- Download the full product to a zip file
+- Get products already resolved by previous runs from the local catalogue
+- Get tile centroides from the local tile index, built once from ESA kml (hard link)
+- Get the product IDs by OpenSearch queries (On Scihub, tiles are referenced by Id name),
+  tiles of the same date and level are grouped in parallel queries
+  answers matched with the tile footprints (NumPy if installed), the product 
+  covering the tile best is kept
+For each tiles, as soon as its product is found (list read, queries and 
+downloads run at the same time)
+- Download the full product to a zip file (partial file resumed, MD5 checked)
     OR
-  Download the product Xml file, then bands
+  Download the product Xml file, then bands (or only the JPEG2000 tiles
+  of a window / lower resolution levels, -window -reduce)
+  (downloads run in parallel, -jobs workers and -hostjobs per host)
+  Rows of the same product share downloads, each file is fetched once then 
+  linked to the other output folders, files already there are skipped
+- Retry failed queries and downloads with backoff (-retry), fewer transfers 
+  per host while the hub answers 429/503
+- Order offline products (Long Term Archive) at once, download them when 
+  restored while online ones go on
+- Check downloaded files in worker processes while downloads go on (-post):
+  MD5, zip structure (CRC with -zipcrc), JPEG2000 signature and end marker
+  on the .part file, renamed only if sound, optionally convert bands to
+  Cloud Optimised GeoTIFF (-cog) and stack the bands of each tile (-stack),
+  both with GDAL Python bindings
+- Plan disk space: each tile reserves its volume (hub product sizes) on its
+  output volume before downloading, tiles without room wait (-budget caps
+  the run), files are written to .part files flushed then renamed
+- Report stage times, throughputs, retries and hub latencies (-report, -progress)
 
 **************************************************************************
 
 '''% __version__,
 formatter_class=argparse.RawDescriptionHelpFormatter)
 #----------------------------------------------------------
-# List of Download Package
+# List of Download Package (resume partial file)
 #----------------------------------------------------------
-dicoDP={'wget': 'wget --no-check-certificate --user={USERNAME} --password={PASSWORD} --output-document={OUTFOLDER}%s{FILENAME} "{URI_QUERY}"'% os.sep,
-    'curl': 'curl -u {USERNAME}:{PASSWORD} -g "{URI_QUERY}" > {OUTFOLDER}%s{FILENAME}'% os.sep,
-    'aria2c': 'aria2c --http-user={USERNAME} --http-passwd={PASSWORD} -d {OUTFOLDER} -o {FILENAME} "{URI_QUERY}"'
+# (wget and curl give the HTTP status: server response on stderr, status code on stdout)
+dicoDP={'wget': 'wget --continue --server-response --no-check-certificate --user={USERNAME} --password={PASSWORD} --output-document={OUTFOLDER}%s{FILENAME} "{URI_QUERY}"'% os.sep,
+    'curl': 'curl -f -u {USERNAME}:{PASSWORD} -g -C - -w "%%{{http_code}}" -o {OUTFOLDER}%s{FILENAME} "{URI_QUERY}"'% os.sep,
+    'aria2c': 'aria2c --continue=true --http-user={USERNAME} --http-passwd={PASSWORD} -d {OUTFOLDER} -o {FILENAME} "{URI_QUERY}"'
+    }
+# Same packages writing on stdout (query answers read in memory), aria2c goes through a temporary file
+dicoDPStdout={'wget': 'wget -q --no-check-certificate --user={USERNAME} --password={PASSWORD} --output-document=- "{URI_QUERY}"',
+    'curl': 'curl -s -f -u {USERNAME}:{PASSWORD} -g "{URI_QUERY}"'
+    }
+# Same packages asking the first byte only and giving the HTTP status (LTA order)
+dicoDPStatus={'wget': 'wget -q --server-response --no-check-certificate --user={USERNAME} --password={PASSWORD} --header="Range: bytes=0-0" --output-document={NULL} "{URI_QUERY}"',
+    'curl': 'curl -s -u {USERNAME}:{PASSWORD} -g -r 0-0 -w "%{{http_code}}" -o {NULL} "{URI_QUERY}"'
     }
 #----------------------------------------------------------
 #Hard arguments
@@ -68,21 +124,53 @@ dicoDP={'wget': 'wget --no-check-certificate --user={USERNAME} --password={PASSW
 # URL Kml military grid to find centroide
 urlGrid=["https://sentinel.esa.int/documents/247904/1955685/S2A_OPER_GIP_TILPAR_MPC__20151209T095117_V20150622T000000_21000101T000000_B00.kml"]
 urlGrid+=['https://hls.gsfc.nasa.gov/wp-content/uploads/2016/03/S2A_OPER_GIP_TILPAR_MPC__20151209T095117_V20150622T000000_21000101T000000_B00.kml']
+# Tile index built from the kml (next to the script)
+nameGridFile="S2_Download_Grid.sqlite"
 # Login Scihub ID
 nameIdFile="S2_Download_IdScihub.txt"
 # URL OpenSearch Scihub API
 urlOS='https://scihub.copernicus.eu/apihub/search?q='
+# Number of tiles OR-combined in one OpenSearch query, answer page size (Scihub maximum 100)
+nbTileQuery=10
+nbRowsQuery=100
+# Rows waiting between pipeline stages, tiles downloading at the same time at most
+nbQueue=100
+# Local catalogue of resolved products and band paths (next to the script), entry life time (days), maximum entries
+nameCacheFile="S2_Download_Cache.sqlite"
+ttlCache=30
+nbCacheMax=100000
+# Footprint matching: points per side of the grid sampling each tile
+nbSampleSide=10
+# Chunk size of streamed downloads (native download package)
+sizeChunk=1<<20
+# JPEG2000 window: first bytes read for the header, largest range request
+sizeHeadJp2=1<<16
+sizeSpanJp2=1<<24
+# Retries of a failed transfer, first backoff delay and longest delay (s), HTTP status worth a retry
+nbRetry=5
+delayRetry=2.0
+delayRetryMax=300.0
+setRetry={408,429,500,502,503,504}
+# Transfer code of an offline product (Long Term Archive, retrieval ordered), poll period and longest wait of a restore (s)
+codeOffline=202
+delayLta=60.0
+delayLtaMax=86400.0
+# Free space kept on each output volume (bytes), share of the product volume per band (estimate of band downloads, index: band number)
+sizeFreeMin=1<<30
+lstShareBand=[0,0.005,0.17,0.17,0.17,0.045,0.045,0.045,0.17,0.005,0.005,0.045,0.045]
 
 #----------------------------------------------------------------------------------------------------
 # Hard commands
 #----------------------------------------------------------------------------------------------------
-def GetDP(dicDP):
+def GetDP(dicDP,nameFirst=None):
     if not 'subprocess' in locals(): import subprocess
+    lstName=list(dicDP.keys())
+    if nameFirst in lstName: lstName.insert(0,lstName.pop(lstName.index(nameFirst)))
     i,maxI=0,len(dicDP)
-    nameDP=list(dicDP.keys())[0]
+    nameDP=lstName[0]
     strDP=None
     while not strDP:
-        nameDP=list(dicDP.keys())[i]
+        nameDP=lstName[i]
         try:
             code=subprocess.check_output([nameDP,'-h'])
             strDP=dicDP[nameDP]
@@ -134,11 +222,16 @@ def BandParse(text):
 
 def ReadListTile(pathFile):
     fileIn=open(pathFile)
+    list=[tilesStuff for tilesStuff in IterListTile(fileIn)]
+    fileIn.close()
+    return list
+
+def IterListTile(fileIn):
+    '''Yield the rows of a tile list file object one by one (file or stdin)'''
     tile,date,level,bands,repOut=None,None,None,None,None
-    list=[]
     for line in fileIn:
         clearLine=line.strip()
-        if clearLine.startswith('#'): continue
+        if not clearLine or clearLine.startswith('#'): continue
         words=[word.strip() for word in clearLine.split(';')]
         if not len(words)==5 : raise RuntimeError("Tile list reading error: %s"% words)
         
@@ -185,112 +278,2222 @@ def ReadListTile(pathFile):
         
         #final check
         if tile and date and level and bands and repOut: 
-            list.append([tile,date,level,bands,repOut])
+            yield [tile,date,level,bands,repOut]
         else : 
             raise RuntimeError("Tile list reading error: %s"% clearLine)
-    
-    fileIn.close()
-    return list
+
+def IterParseFlat(source):
+    '''
+    End events of ET.iterparse with the parent of each element (None for 
+    the root). A record cleared then removed from its parent once read 
+    keeps the tree flat however long the file.
+    '''
+    lstOpen=[]
+    for event,elem in ET.iterparse(source,events=('start','end')):
+        if event=='start':
+            lstOpen.append(elem)
+            continue
+        lstOpen.pop()
+        yield elem,lstOpen[-1] if lstOpen else None
 
 def ReadMeta4(pathFile,bands):
-    tree=ET.parse(pathFile)
-    root=tree.getroot()
-    noise=root.tag.replace('}metalink','}')
-    
-    lst=[]
-    for prod in root:
-        title=prod.attrib['name'].replace('.zip','')
-        ident=prod.find(noise+'hash').text
-        # server change dhus TO apihub 
-        urlOD=prod.find(noise+'url').text.replace('dhus','apihub')
+    return list(IterMeta4(pathFile,bands))
+
+def IterMeta4(pathFile,bands):
+    '''
+    Stream a .meta4 cart and yield one resolved row per product (MD5 and 
+    size added, other hash types left out), each file element is dropped 
+    once read (large carts are never held in memory, IterParseFlat).
+    '''
+    noise=None
+    dicDate={}   # sensing dates parsed once
+    for elem,parent in IterParseFlat(pathFile):
+        if noise is None: noise=elem.tag.split('}')[0]+'}'
+        if not elem.tag==noise+'file': continue
         
+        title=elem.attrib['name'].replace('.zip','')
+        md5,urlOD,size=None,None,None
+        for child in elem:
+            if child.tag==noise+'hash':
+                if child.get('type','').lower()=='md5': md5=child.text
+            elif child.tag==noise+'size': size=int(child.text)
+            # server change dhus TO apihub 
+            elif child.tag==noise+'url': urlOD=child.text.replace('dhus','apihub')
+        elem.clear()
+        if parent is not None: parent.remove(elem)
+        ident=urlOD.split("Products('")[-1].split("')")[0]
         
         words=title.split('_')
         tile=words[5][1:]
-        date=words[2][:8]
+        if not words[2][:8] in dicDate: dicDate[words[2][:8]]=strptime(words[2][:8], '%Y%m%d')
+        date=dicDate[words[2][:8]]
         level='S2MSI'+words[1][-2:]
         repOut=os.curdir
         
-        lst.append([tile,date,level,bands,repOut,title,ident,urlOD])
-    return lst
+        yield [tile,date,level,bands,repOut,title,ident,urlOD,md5,size]
 
-def ParseKml(lstUrlKml,listTile):
-    dicCenter=dict((name,None) for name in listTile)
-    
+def ParseKml(lstUrlKml):
+    '''
+    Stream the ESA military grid kml (first url answering) and yield each 
+    tile name, centroide [lon,lat] and footprint polygons [[[lon,lat],..],..]. 
+    Placemarks are dropped once read, the kml is never held in memory 
+    (IterParseFlat).
+    '''
     if not 'urllib' in locals(): import urllib.request
-    fileKml,k='',0
+    fileKml,k=None,0
     while not fileKml:
         try:
-            fileKml=urllib.request.urlopen(lstUrlKml[k]).read()
-        except urllib.error.URLError or ValueError:
+            fileKml=urllib.request.urlopen(lstUrlKml[k])
+        except (urllib.error.URLError,ValueError):
             k+=1
             if k>len(lstUrlKml)-1: raise RuntimeError("ESA military grid kml file did not find")
     
-    root = ET.fromstring(fileKml)
-    noise=root.tag.split('}')[0]+'}'
-    
-    for tile in root.iter(noise+'Placemark'):
-        nameTile=tile[0].text
-        if not nameTile in listTile or dicCenter[nameTile]: continue
-        centerStr=tile[4][1][0].text.split(',')[:2]
-        center=[float(elem) for elem in centerStr]
-        dicCenter[nameTile]=center
+    noise=None
+    for elem,parent in IterParseFlat(fileKml):
+        if noise is None: noise=elem.tag.split('}')[0]+'}'
+        if not elem.tag==noise+'Placemark': continue
         
-        if not None in dicCenter.values(): break
-    
-    del fileKml,root,centerStr,center
+        nameTile=elem.find(noise+'name').text
+        centerStr=elem.find('.//%sPoint/%scoordinates'% (noise,noise)).text.split(',')[:2]
+        center=[float(val) for val in centerStr]
+        lstPoly=[[[float(val) for val in point.split(',')[:2]] for point in coord.text.split()] for coord in elem.iterfind('.//%sPolygon//%scoordinates'% (noise,noise))]
+        elem.clear()
+        if parent is not None: parent.remove(elem)
+        
+        yield nameTile,center,lstPoly
     
-    if None in dicCenter.values(): raise RuntimeError("Tile did not find :"+dicCenter)
-    return dicCenter
+    fileKml.close()
 
-def CreateOSQuery(url,name,date,level,dicoCenter):
-    # BY centroide
-    url+='footprint:\\"Intersects(%s,%s)\\"'% (dicoCenter[name][1],dicoCenter[name][0])    
+def CreateOSQuery(url,lstName,date,level,dicoCenter,start=0,rows=nbRowsQuery):
+    # BY centroide, one footprint per tile
+    lstFootprint=['footprint:"Intersects(%s,%s)"'% (dicoCenter[name][1],dicoCenter[name][0]) for name in lstName]
+    if len(lstFootprint)==1:
+        url+=lstFootprint[0]
+    else:
+        url+='(%s)'% ' OR '.join(lstFootprint)
     # DATE & Level
     url+=' AND filename:S2* AND beginposition:[%s00:00:00.000Z TO %s23:59:00.000Z] AND producttype:%s'% (strftime('%Y-%m-%dT',date),strftime('%Y-%m-%dT',date),level)
-    
-    if formatDP.startswith('curl'): url=url.replace(' ','%20')
+    # Page
+    url+='&start=%i&rows=%i'% (start,rows)
     
     return url
 
-def ParseOSQuery(pathFile,nameTile,date):
-    title,id,url=None,None,None
-    tree=ET.parse(pathFile)
-    root=tree.getroot()
-    noise=root.tag.split('}')[0]+'}'
+def ParseSize(text):
+    '''Bytes of a hub size ("805.31 MB"), None if unreadable'''
+    words=(text or '').split()
+    dicUnit={'B': 0, 'KB': 1, 'MB': 2, 'GB': 3, 'TB': 4}
+    try:
+        return int(float(words[0])*1024**dicUnit[words[1].upper()])
+    except (IndexError,KeyError,ValueError):
+        return None
+
+def ParseWkt(text):
+    '''Rings [[lon,lat],..] of a WKT (MULTI)POLYGON footprint, holes are taken as rings too'''
+    return [[[float(val) for val in point.split()[:2]] for point in ring.split(',')] for ring in re.findall(r'\(([^()]+)\)',text)]
+
+def InPolygons(lstPoint,lstRing):
+    '''
+    Point in polygon test (even-odd rule) of points [[lon,lat],..] 
+    against rings [[[lon,lat],..],..]. All points of a ring are tested at 
+    once with NumPy (loops without). Returns one boolean per point, True if 
+    the point is inside any ring.
+    '''
+    if np is None:
+        lstIn=[False]*len(lstPoint)
+        for ring in lstRing:
+            for k,(x,y) in enumerate(lstPoint):
+                if lstIn[k]: continue
+                for (x0,y0),(x1,y1) in zip(ring,ring[1:]+ring[:1]):
+                    if (y0>y)!=(y1>y) and x<(x1-x0)*(y-y0)/(y1-y0)+x0: lstIn[k]=not lstIn[k]
+        return lstIn
+    
+    arrPoint=np.asarray(lstPoint,dtype=float).reshape(-1,2)
+    arrIn=np.zeros(len(arrPoint),dtype=bool)
+    x,y=arrPoint[:,:1],arrPoint[:,1:]
+    for ring in lstRing:
+        arrRing=np.asarray(ring,dtype=float)
+        x0,y0=arrRing[:,0],arrRing[:,1]
+        x1,y1=np.roll(x0,-1),np.roll(y0,-1)
+        # points x edges
+        arrSpan=(y0>y)!=(y1>y)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            arrCross=arrSpan & (x<(x1-x0)*(y-y0)/(y1-y0)+x0)
+        arrIn|=arrCross.sum(axis=1)%2==1
+    return arrIn
+
+def TileSamples(lstPoly,nbSide=nbSampleSide):
+    '''Points of a regular nbSide x nbSide grid over a tile footprint which are inside it (none without footprint)'''
+    lstLon=[point[0] for ring in lstPoly for point in ring]
+    lstLat=[point[1] for ring in lstPoly for point in ring]
+    if not lstLon: return []
+    stepLon=(max(lstLon)-min(lstLon))/nbSide
+    stepLat=(max(lstLat)-min(lstLat))/nbSide
+    lstPoint=[[min(lstLon)+(i+0.5)*stepLon,min(lstLat)+(j+0.5)*stepLat] for i in range(nbSide) for j in range(nbSide)]
+    return [point for point,isIn in zip(lstPoint,InPolygons(lstPoint,lstPoly)) if isIn]
+
+def Coverage(lstRing,lstTile,dicoSample):
+    '''
+    Share of each tile of lstTile (sampled by TileSamples) inside the 
+    footprint rings, every tile in one point in polygon pass.
+    '''
+    lstTile=[nameTile for nameTile in lstTile if dicoSample.get(nameTile)]
+    if not lstTile: return {}
+    lstNb=[len(dicoSample[nameTile]) for nameTile in lstTile]
+    lstIn=InPolygons([point for nameTile in lstTile for point in dicoSample[nameTile]],lstRing)
+    
+    if np is not None:
+        arrCover=np.add.reduceat(lstIn.astype(float),np.cumsum([0]+lstNb[:-1]))/lstNb
+        return dict(zip(lstTile,arrCover.tolist()))
+    
+    dicCover,k={},0
+    for nameTile,nb in zip(lstTile,lstNb):
+        dicCover[nameTile]=float(sum(lstIn[k:k+nb]))/nb
+        k+=nb
+    return dicCover
+
+def ParseOSQuery(content,lstTile,date,dicoSample=None):
+    '''
+    Match entries of a query answer (bytes) with the tiles of lstTile 
+    sensed at date. Returns {tile: [title,id,url,online,coverage,size]} and the 
+    total number of results given by the hub (for paging), online is False 
+    for products in the Long Term Archive (ondemand element, online field 
+    of other hubs), size in bytes (None if not given). With the tile samples 
+    (TileSamples), coverage is the share of the tile inside the product 
+    footprint: products without tile id in their title (multi-tile) are 
+    matched with every tile they cover, and the product covering a tile 
+    best is kept. The answer is streamed, entries are dropped once read and 
+    reading stops as soon as every tile has its product.
+    '''
+    dicFound={}
+    setLeft=set(lstTile)   # tiles which could still get a better product
+    dateStr=strftime('%Y-%m-%d',date)
     
-    for entry in root.findall(noise+'entry'):
-        if not entry.find(noise+'title').text.startswith('S2'): continue
-        title=entry.find(noise+'title').text
+    nbTotal,noise,tagEntry=0,None,None
+    for elem,parent in IterParseFlat(io.BytesIO(content)):
+        if not elem.tag==tagEntry:
+            if noise is None:
+                noise=elem.tag.split('}')[0]+'}'
+                tagEntry=noise+'entry'
+            if not nbTotal and elem.tag.endswith('}totalResults'): nbTotal=int(elem.text)
+            continue
+        
+        dicAttr={}
+        for child in elem:
+            name=child.get('name')
+            if name:
+                if name in ('beginposition','tileid','footprint','online','size'): dicAttr[name]=child.text
+            elif child.tag==noise+'link':
+                dicAttr.setdefault('link',child.get('href'))
+            elif child.tag in (noise+'title',noise+'id',noise+'ondemand'):
+                dicAttr[child.tag[len(noise):]]=child.text
+        elem.clear()
+        if parent is not None: parent.remove(elem)
+        
+        title=dicAttr.get('title') or ''
+        if not title.startswith('S2'): continue
         wordsTitle=title.split('_')
         
-        #match query answer (Tile)
-        if not wordsTitle[5][1:]==nameTile : continue
         #match query answer (Date)
-        if not wordsTitle[2][:8]==strftime('%Y%m%d',date) : continue
+        if 'beginposition' in dicAttr:
+            if not dicAttr['beginposition'][:10]==dateStr: continue
+        elif not wordsTitle[2][:8]==dateStr.replace('-',''): continue
+        
+        #match query answer (Tile)
+        tileId=dicAttr.get('tileid')
+        if not tileId and len(wordsTitle)>5 and re.match(r'T\d\d[A-Z]{3}$',wordsTitle[5]): tileId=wordsTitle[5][1:]
+        if tileId and not tileId in setLeft: continue
+        dicCover={}
+        if dicoSample and dicAttr.get('footprint'): dicCover=Coverage(ParseWkt(dicAttr['footprint']),[tileId] if tileId else list(setLeft),dicoSample)
+        if tileId:
+            lstMatch=[tileId]
+        else:
+            lstMatch=[nameTile for nameTile,cover in dicCover.items() if cover>0]
         
-        id=entry.find(noise+'id').text
-        url=entry.find(noise+'link').attrib['href']
+        if 'online' in dicAttr: online=not (dicAttr['online'] or '').strip().lower()=='false'
+        else: online=not (dicAttr.get('ondemand') or '').strip().lower()=='true'
+        for nameTile in lstMatch:
+            cover=dicCover.get(nameTile,0.0)
+            if nameTile in dicFound and dicFound[nameTile][4]>=cover: continue
+            dicFound[nameTile]=[title,dicAttr.get('id'),dicAttr.get('link'),online,cover,ParseSize(dicAttr.get('size'))]
+            # whole tile covered (or coverage unknown), nothing better to come
+            if cover>=1.0 or not dicoSample or not nameTile in dicoSample: setLeft.discard(nameTile)
+        if not setLeft: break
     
-    return title,id,url
+    return dicFound,nbTotal
+
+def QueryGroup(pool,lstName,date,level,dicoCenter,dicoSample=None,stop=None):
+    '''
+    Send the OR-combined query of tiles lstName and walk the answer pages 
+    until every tile is found, the pages are over or stop is set. Returns 
+    {tile: [title,id,url,online,size]}, the best covering product of each 
+    tile with dicoSample (see ParseOSQuery).
+    '''
+    dicFound={}
+    start,nbTotal=0,1
+    while start<nbTotal and len(dicFound)<len(lstName):
+        if stop and stop.is_set(): break
+        urlCur=CreateOSQuery(urlOS,lstName,date,level,dicoCenter,start=start)
+        content=pool.Read(urlCur,stop=stop)
+        if not content:
+            print("--Query empty : %s-%s"% (strftime('%Y%m%d',date),'-'.join(lstName)))
+            break
+        
+        try:
+            dicPage,nbTotal=ParseOSQuery(content,lstName,date,dicoSample)
+        except (ET.ParseError,ValueError) as msg:
+            # not an Atom feed (error page) or unreadable footprint
+            print("--Query empty (%s) : %s-%s"% (msg,strftime('%Y%m%d',date),'-'.join(lstName)))
+            break
+        for nameTile,lstRes in dicPage.items():
+            if nameTile in dicFound and dicFound[nameTile][4]>=lstRes[4]: continue
+            dicFound[nameTile]=lstRes
+        start+=nbRowsQuery
+    
+    return dict((nameTile,lstRes[:4]+lstRes[5:]) for nameTile,lstRes in dicFound.items())
+
+def UrlXml(urlOD,title,level):
+    '''Name and url of the product Xml file'''
+    xmlName='MTD_MSIL%s.xml'% level[-2:]
+    return xmlName,'/'.join( urlOD.split('/')[:-1]+["Nodes('%s.SAFE')"% title]+["Nodes('%s')"% xmlName]+['$value'] )
+
+def UrlBand(urlOD,title,relatPath):
+    '''Url of a file given by its path in the SAFE folder'''
+    return '/'.join( urlOD.split('/')[:-1]+["Nodes('%s.SAFE')"% title]+["Nodes('%s')"% elem for elem in relatPath.split('/')]+['$value'] )
 
 def ReadS2XML(path,level):
-    tree=ET.parse(path)
-    root=tree.getroot()
-    
-    if level=='S2MSI1C':
-        print('1C')
-        dico=dict([(elem.text.split('_')[-1],elem.text+'.jp2') for elem in root.iter('IMAGE_FILE')])
-    elif level=='S2MSI2A':
-        print('L2A')
-        dico={}
-        for elem in root.iter('IMAGE_FILE'):
+    '''
+    Band paths {band: relative path} of the product Xml file, streamed up 
+    to the end of the product organisation (the quality and auxiliary 
+    parts are not read).
+    '''
+    if level=='S2MSI1C': print('1C')
+    elif level=='S2MSI2A': print('L2A')
+    
+    dico={}
+    for event,elem in ET.iterparse(path):
+        tag=elem.tag.split('}')[-1]
+        if tag=='Product_Organisation': break
+        if not tag=='IMAGE_FILE': continue
+        if level=='S2MSI1C':
+            dico[elem.text.split('_')[-1]]=elem.text+'.jp2'
+        elif level=='S2MSI2A':
+            # finest resolution first
             key=elem.text.split('_')[-2]
-            if key in dico: continue
-            dico[key]=elem.text+'.jp2'
+            if not key in dico: dico[key]=elem.text+'.jp2'
     
     return dico
 
+def SizePart(pathOut):
+    '''Bytes of pathOut on disk, final file or .part (split parts included)'''
+    if os.path.exists(pathOut): return os.path.getsize(pathOut)
+    size=0
+    dirName,baseName=os.path.split(pathOut)
+    for name in os.listdir(dirName or os.curdir):
+        if name.startswith(baseName+'.part'): size+=os.path.getsize(os.path.join(dirName,name))
+    return size
+
+def RangeLayout(pathPart):
+    '''Number of ranges of the split download of pathPart left by a previous attempt, None if none'''
+    dirName,baseName=os.path.split(pathPart)
+    for name in os.listdir(dirName or os.curdir):
+        match=re.match(r'(\d+)-\d+$',name[len(baseName):]) if name.startswith(baseName) else None
+        if match: return int(match.group(1))
+    return None
+
+def RemoveRanges(pathPart):
+    '''Remove the range files of pathPart (split download)'''
+    dirName,baseName=os.path.split(pathPart)
+    for name in os.listdir(dirName or os.curdir):
+        if name.startswith(baseName) and not name==baseName: os.remove(os.path.join(dirName,name))
+
+def CommitFile(pathPart,pathOut,md5=None,commit=True):
+    '''
+    Put the complete pathPart at pathOut: never empty and MD5 checked if 
+    given (a bad file is removed, returns 1), data flushed to disk then 
+    renamed at once, a file at pathOut is always whole. Without commit, 
+    pathPart is only checked and stays (committed after the post checks, 
+    PostFile). Returns 0 if ok.
+    '''
+    if not os.path.getsize(pathPart):
+        print("--Empty answer : %s"% os.path.basename(pathOut))
+        os.remove(pathPart)
+        return 1
+    if md5 and not Md5File(pathPart).lower()==md5.lower():
+        print("--MD5 mismatch : %s"% os.path.basename(pathOut))
+        os.remove(pathPart)
+        return 1
+    if not commit: return 0
+    with open(pathPart,'rb+') as fileIn: os.fsync(fileIn.fileno())
+    os.replace(pathPart,pathOut)
+    if hasattr(os,'O_DIRECTORY'):
+        # the rename itself flushed (folder entry)
+        fd=os.open(os.path.dirname(pathOut) or os.curdir,os.O_RDONLY|os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    return 0
+
+def LinkFile(pathSrc,pathOut):
+    '''Put pathSrc at pathOut too, by hard link if the file system allows it, else by copy (committed whole)'''
+    if os.path.exists(pathOut): return
+    os.makedirs(os.path.dirname(pathOut),exist_ok=True)
+    try:
+        os.link(pathSrc,pathOut)
+    except OSError:
+        shutil.copy2(pathSrc,pathOut+'.part')
+        CommitFile(pathOut+'.part',pathOut)
+
+def Md5File(path):
+    md5=hashlib.md5()
+    with open(path,'rb') as fileIn:
+        chunk=fileIn.read(sizeChunk)
+        while chunk:
+            md5.update(chunk)
+            chunk=fileIn.read(sizeChunk)
+    return md5.hexdigest()
+
+#----------------------------------------------------------------------------------------------------
+# Transport
+#----------------------------------------------------------------------------------------------------
+class TransportCmd:
+    '''
+    External download package (wget, curl, aria2c) forked for each file 
+    through the dicoDP command templates.
+    '''
+    def __init__(self,formatDP,lstLogin):
+        self.formatDP=formatDP
+        self.nameDP=formatDP.split()[0]
+        self.lstLogin=lstLogin
+        self.local=threading.local()
+        self.stats=None
+    
+    def Status(self,proc):
+        '''HTTP status and Retry-After (s) of a finished package command, (None,None) if it does not tell'''
+        if self.nameDP=='curl':
+            code=(proc.stdout or b'').decode(errors='replace').strip()[-3:]
+            return (int(code),None) if code.isdigit() and not code=='000' else (None,None)
+        if self.nameDP=='wget':
+            text=(proc.stderr or b'').decode(errors='replace')
+            lstStatus=re.findall(r'HTTP/[\d.]+ (\d{3})',text)
+            lstRetry=re.findall(r'Retry-After: *(\d+)',text)
+            return int(lstStatus[-1]) if lstStatus else None,float(lstRetry[-1]) if lstRetry else None
+        return None,None
+    
+    def Failure(self):
+        '''HTTP status and Retry-After of the last failure of the current thread (None if the package does not tell), then forgotten'''
+        failure=getattr(self.local,'failure',(None,None))
+        self.local.failure=(None,None)
+        return failure
+    
+    def Order(self,url):
+        '''
+        Ask the first byte of url (an offline product answers 202 and is 
+        ordered), returns the HTTP status (None if unknown). aria2c does 
+        not give it: the answer goes to a temporary folder then.
+        '''
+        if self.nameDP in dicoDPStatus:
+            cmd=dicoDPStatus[self.nameDP].format(USERNAME=self.lstLogin[0], PASSWORD=self.lstLogin[1], NULL=os.devnull, URI_QUERY=self.Quote(url))
+            return self.Status(subprocess.run(cmd,shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE))[0]
+        
+        repTemp=tempfile.mkdtemp()
+        returnCode=self.Fetch(url,repTemp,'order')
+        shutil.rmtree(repTemp)
+        return None if returnCode else 200
+    
+    def Quote(self,url):
+        '''Escape url for the shell command line'''
+        url=url.replace('"','\\"')
+        #Unix special character
+        if sys.platform.startswith('linux') or sys.platform.startswith('darwin'): url=url.replace('$','\\$')
+        if self.nameDP=='curl': url=url.replace(' ','%20')
+        return url
+    
+    def Fetch(self,url,outFolder,fileName,pourcent=0.0,nbSplit=1,stop=None,md5=None,commit=True,nbThread=None):
+        '''
+        Download url to outFolder/fileName through a .part file resumed by 
+        the package and committed (CommitFile, md5 checked if given) at 
+        the end, returns 0 if ok (nbSplit, stop and nbThread are not used). An error 
+        status or a 202 (offline product, its body dropped) is kept for 
+        Failure, an empty body is never committed.
+        '''
+        cmd=self.formatDP.format(USERNAME=self.lstLogin[0], PASSWORD=self.lstLogin[1], OUTFOLDER=outFolder ,FILENAME=fileName+'.part', URI_QUERY=self.Quote(url))
+        print("--%s-%.2f%%: %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),pourcent,cmd))
+        if self.nameDP in dicoDPStatus:
+            proc=subprocess.run(cmd,shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        else:
+            proc=subprocess.run(cmd,shell=True)
+        returnCode=proc.returncode
+        
+        pathOut=os.path.join(outFolder,fileName)
+        status,retryAfter=self.Status(proc)
+        if status==202 or (status and status>=400 and not status==416):
+            print("--HTTP %i : %s"% (status,url))
+            self.local.failure=(status,retryAfter)
+            if status==202 and os.path.exists(pathOut+'.part'): os.remove(pathOut+'.part')
+            return returnCode or 1
+        if status==416 and os.path.exists(pathOut+'.part') and os.path.getsize(pathOut+'.part'):
+            # .part complete already (run stopped before the rename), checked by CommitFile
+            returnCode=0
+        if not returnCode and os.path.exists(pathOut+'.part'): returnCode=CommitFile(pathOut+'.part',pathOut,md5,commit)
+        return returnCode
+    
+    def Read(self,url):
+        '''Download url in memory, returns the content or None'''
+        if self.nameDP in dicoDPStdout:
+            cmd=dicoDPStdout[self.nameDP].format(USERNAME=self.lstLogin[0], PASSWORD=self.lstLogin[1], URI_QUERY=self.Quote(url))
+            print("--%s: %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),cmd))
+            proc=subprocess.run(cmd,shell=True,stdout=subprocess.PIPE)
+            if proc.returncode: return None
+            return proc.stdout
+        
+        repTemp=tempfile.mkdtemp()
+        returnCode=self.Fetch(url,repTemp,'query.xml')
+        content=None
+        if not returnCode and os.path.exists(os.path.join(repTemp,'query.xml')):
+            content=open(os.path.join(repTemp,'query.xml'),'rb').read()
+        shutil.rmtree(repTemp)
+        return content
+    
+    def Close(self):
+        pass
+
+class TransportHttp:
+    '''
+    In-process HTTP client. Keep-alive connections are pooled per host and 
+    reused by the following requests (one TLS handshake per connection 
+    instead of one per file), bodies are streamed to disk by chunks.
+    '''
+    def __init__(self,lstLogin,timeout=120):
+        self.lstLogin=lstLogin
+        self.timeout=timeout
+        self.auth='Basic '+base64.b64encode(('%s:%s'% tuple(lstLogin)).encode()).decode()
+        self.context=ssl.create_default_context()
+        self.dicIdle={}   # (scheme, host): idle connections
+        self.lock=threading.Lock()
+        self.local=threading.local()
+        self.stats=None
+    
+    def Fail(self,resp):
+        '''Keep status and Retry-After (seconds) of a failed response for the current thread'''
+        retryAfter=(resp.getheader('Retry-After') or '').strip()
+        delay=None
+        if retryAfter.isdigit():
+            delay=float(retryAfter)
+        elif retryAfter and email.utils.parsedate_tz(retryAfter):
+            delay=max(0.0,email.utils.mktime_tz(email.utils.parsedate_tz(retryAfter))-time.time())
+        self.local.failure=(resp.status,delay)
+    
+    def Failure(self):
+        '''Status and Retry-After of the last failure of the current thread (None if network error), then forgotten'''
+        failure=getattr(self.local,'failure',(None,None))
+        self.local.failure=(None,None)
+        return failure
+    
+    def Quote(self,url):
+        '''Percent-encode the characters HTTP does not allow (spaces, quotes, brackets)'''
+        return urllib.parse.quote(url,safe=":/?&=()'$,*+%@!;")
+    
+    def Connection(self,key):
+        with self.lock:
+            if self.dicIdle.get(key): return self.dicIdle[key].pop(),True
+        scheme,host=key
+        if scheme=='https':
+            return http.client.HTTPSConnection(host,timeout=self.timeout,context=self.context),False
+        return http.client.HTTPConnection(host,timeout=self.timeout),False
+    
+    def Release(self,key,conn,resp):
+        '''Give back a connection whose response is fully read'''
+        if resp.will_close:
+            conn.close()
+            return
+        with self.lock:
+            self.dicIdle.setdefault(key,[]).append(conn)
+    
+    def Request(self,url,dicHeader={}):
+        '''
+        Send GET url and follow redirections (credentials are only given 
+        to the first host). Returns key, connection and response whose 
+        body is still to read.
+        '''
+        hostAuth=None
+        for k in range(5):
+            parts=urllib.parse.urlsplit(self.Quote(url))
+            key=(parts.scheme,parts.netloc)
+            if hostAuth is None: hostAuth=parts.netloc
+            path=parts.path+('?'+parts.query if parts.query else '')
+            
+            dicHeaderCur={'Connection': 'keep-alive', 'User-Agent': 'S2_Download/%.1f'% __version__}
+            if parts.netloc==hostAuth: dicHeaderCur['Authorization']=self.auth
+            dicHeaderCur.update(dicHeader)
+            
+            conn,reused=self.Connection(key)
+            start=time.time()
+            try:
+                conn.request('GET',path,headers=dicHeaderCur)
+                resp=conn.getresponse()
+            except (http.client.HTTPException,OSError):
+                conn.close()
+                if not reused: raise
+                # idle connection closed by the server, a new one is opened
+                if self.stats: self.stats.AddRetry()
+                conn,reused=self.Connection(key)
+                start=time.time()
+                conn.request('GET',path,headers=dicHeaderCur)
+                resp=conn.getresponse()
+            if self.stats: self.stats.AddLatency(time.time()-start)
+            
+            if resp.status in (301,302,303,307,308) and resp.getheader('Location'):
+                resp.read()
+                self.Release(key,conn,resp)
+                url=urllib.parse.urljoin(url,resp.getheader('Location'))
+                continue
+            
+            return key,conn,resp
+        
+        raise http.client.HTTPException('Too many redirections : %s'% url)
+    
+    def Fetch(self,url,outFolder,fileName,pourcent=0.0,nbSplit=1,stop=None,md5=None,commit=True,nbThread=None):
+        '''
+        Download url to outFolder/fileName, returns 0 if ok. The body goes 
+        to a .part file committed at the end (CommitFile, md5 checked if 
+        given), an existing .part file is resumed 
+        with a Range request. With nbSplit>1, a large file is cut in nbSplit 
+        byte ranges downloaded by nbThread threads (nbSplit if None) then 
+        put together, ranges left by a previous attempt keep their layout 
+        and are resumed. Setting the stop event ends the transfer at the 
+        next chunk.
+        '''
+        pathOut=os.path.join(outFolder,fileName)
+        print("--%s-%.2f%%: GET %s > %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),pourcent,url,pathOut))
+        try:
+            nbSplit=RangeLayout(pathOut+'.part') or nbSplit
+            size=None
+            if nbSplit>1: size=self.Size(url)
+            if size and size>nbSplit*sizeChunk:
+                returnCode=self.FetchSplit(url,pathOut+'.part',size,nbSplit,nbThread or nbSplit,stop)
+            else:
+                returnCode=self.FetchRange(url,pathOut+'.part',stop=stop)
+        except (http.client.HTTPException,OSError) as msg:
+            print("--HTTP error %s : %s"% (msg,url))
+            return 1
+        
+        if returnCode: return returnCode
+        return CommitFile(pathOut+'.part',pathOut,md5,commit)
+    
+    def FetchRange(self,url,pathPart,start=0,end=None,stop=None):
+        '''
+        Download bytes start to end (included, None up to the end of file) of 
+        url to pathPart, from the current size of pathPart. Returns 0 if ok.
+        '''
+        sizePart=0
+        if os.path.exists(pathPart): sizePart=os.path.getsize(pathPart)
+        if end is not None and start+sizePart>end: return 0
+        
+        dicHeader={}
+        if start+sizePart or end is not None:
+            dicHeader['Range']='bytes=%i-%s'% (start+sizePart,'' if end is None else end)
+        key,conn,resp=self.Request(url,dicHeader)
+        
+        if resp.status==416 and sizePart and end is None:
+            # nothing left after the partial file
+            resp.read()
+            self.Release(key,conn,resp)
+            total=(resp.getheader('Content-Range') or '').split('/')[-1]
+            if total.isdigit() and int(total)==sizePart: return 0
+            return 1
+        elif resp.status==200 and not start:
+            # Range ignored by the server, from byte 0
+            mode='wb'
+        elif resp.status==206:
+            mode='ab'
+        else:
+            resp.read()
+            self.Release(key,conn,resp)
+            self.Fail(resp)
+            print("--HTTP %i : %s"% (resp.status,url))
+            return 1
+        
+        size=0
+        with open(pathPart,mode) as fileOut:
+            chunk=resp.read(sizeChunk)
+            while chunk:
+                fileOut.write(chunk)
+                size+=len(chunk)
+                if stop and stop.is_set():
+                    conn.close()
+                    return 1
+                chunk=resp.read(sizeChunk)
+        
+        length=resp.getheader('Content-Length')
+        self.Release(key,conn,resp)
+        if length and not int(length)==size: return 1
+        return 0
+    
+    def FetchSplit(self,url,pathPart,size,nbSplit,nbThread,stop=None):
+        '''
+        Download url by nbSplit ranges on nbThread threads then put them 
+        together in pathPart, range files are removed once merged. A 
+        failure of a range thread is given to the calling one (Failure), 
+        the hub push back first.
+        '''
+        step=-(-size//nbSplit)
+        lstRange=[(k*step,min(size,(k+1)*step)-1) for k in range(nbSplit)]
+        lstPath=['%s%i-%i'% (pathPart,nbSplit,k) for k in range(nbSplit)]
+        def Range(k):
+            returnCode=self.FetchRange(url,lstPath[k],*lstRange[k],stop=stop)
+            return returnCode,self.Failure()
+        
+        with ThreadPoolExecutor(max_workers=min(nbThread,nbSplit)) as executor:
+            lstRes=list(executor.map(Range,range(nbSplit)))
+        lstFailure=[failure for returnCode,failure in lstRes if failure[0] is not None]
+        if lstFailure: self.local.failure=max(lstFailure,key=lambda failure: (failure[0] in (429,503),failure[1] or 0))
+        if sum(returnCode for returnCode,failure in lstRes): return 1
+        
+        with open(pathPart,'wb') as fileOut:
+            for pathCur in lstPath:
+                with open(pathCur,'rb') as fileIn: shutil.copyfileobj(fileIn,fileOut,sizeChunk)
+        RemoveRanges(pathPart)
+        
+        if not os.path.getsize(pathPart)==size: return 1
+        return 0
+    
+    def ReadRange(self,url,start,end):
+        '''Bytes start to end (included) of url in memory and the total size of url (None if unknown)'''
+        key,conn,resp=self.Request(url,{'Range': 'bytes=%i-%i'% (start,end)})
+        content=resp.read()
+        self.Release(key,conn,resp)
+        if resp.status==200:
+            # Range ignored by the server
+            return content[start:end+1],len(content)
+        if not resp.status==206:
+            self.Fail(resp)
+            raise http.client.HTTPException('HTTP %i : %s'% (resp.status,url))
+        total=(resp.getheader('Content-Range') or '').split('/')[-1]
+        return content,int(total) if total.isdigit() else None
+    
+    def Size(self,url):
+        '''Total size of url from a one byte range request, None if unknown'''
+        key,conn,resp=self.Request(url,{'Range': 'bytes=0-0'})
+        if not resp.status==206:
+            # whole body coming, the connection is dropped
+            conn.close()
+            return None
+        resp.read()
+        self.Release(key,conn,resp)
+        total=(resp.getheader('Content-Range') or '').split('/')[-1]
+        if total.isdigit(): return int(total)
+        return None
+    
+    def Order(self,url):
+        '''
+        Ask url (an offline product) without reading the product, returns 
+        the HTTP status (202 Accepted once the retrieval is ordered, 
+        200/206 if already online) or None.
+        '''
+        print("--%s: ORDER %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),url))
+        try:
+            key,conn,resp=self.Request(url,{'Range': 'bytes=0-0'})
+            if resp.status==200:
+                # whole body coming, the connection is dropped
+                conn.close()
+            else:
+                resp.read()
+                self.Release(key,conn,resp)
+        except (http.client.HTTPException,OSError) as msg:
+            print("--HTTP error %s : %s"% (msg,url))
+            return None
+        return resp.status
+    
+    def Read(self,url):
+        '''Download url in memory, returns the content or None'''
+        print("--%s: GET %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),url))
+        try:
+            key,conn,resp=self.Request(url)
+            content=resp.read()
+            self.Release(key,conn,resp)
+        except (http.client.HTTPException,OSError) as msg:
+            print("--HTTP error %s : %s"% (msg,url))
+            return None
+        
+        if not resp.status==200: 
+            self.Fail(resp)
+            print("--HTTP %i : %s"% (resp.status,url))
+            return None
+        return content
+    
+    def Close(self):
+        with self.lock:
+            for lstConn in self.dicIdle.values():
+                for conn in lstConn: conn.close()
+            self.dicIdle={}
+
+#----------------------------------------------------------------------------------------------------
+# JPEG2000 window
+#----------------------------------------------------------------------------------------------------
+def LonLatToUtm(lon,lat,zone,north=True):
+    '''WGS84 degrees to UTM metres [x,y] of zone (transverse Mercator series, mm in the zone)'''
+    a,f,k0=6378137.0,1/298.257223563,0.9996
+    e2=f*(2-f)
+    ep2=e2/(1-e2)
+    phi,lam=math.radians(lat),math.radians(lon-(6*zone-183))
+    N=a/math.sqrt(1-e2*math.sin(phi)**2)
+    T=math.tan(phi)**2
+    C=ep2*math.cos(phi)**2
+    A=math.cos(phi)*lam
+    M=a*((1-e2/4-3*e2**2/64-5*e2**3/256)*phi-(3*e2/8+3*e2**2/32+45*e2**3/1024)*math.sin(2*phi)
+        +(15*e2**2/256+45*e2**3/1024)*math.sin(4*phi)-35*e2**3/3072*math.sin(6*phi))
+    x=500000.0+k0*N*(A+(1-T+C)*A**3/6+(5-18*T+T**2+72*C-58*ep2)*A**5/120)
+    y=k0*(M+N*math.tan(phi)*(A**2/2+(5-T+9*C+4*C**2)*A**4/24+(61-58*T+T**2+600*C-330*ep2)*A**6/720))
+    if not north: y+=10000000.0
+    return [x,y]
+
+class Jp2Window:
+    '''
+    Remote JPEG2000 band read by byte ranges: the file head gives the boxes, 
+    the georeference (GMLJP2) and the codestream main header, then the 
+    tile-part index comes from the TLM marker or, without it, from a walk 
+    along the SOT markers. Write keeps only the codestream tiles covering 
+    a map window and/or drops the highest resolution levels.
+    '''
+    def __init__(self,transport,url):
+        self.transport=transport
+        self.url=url
+        self.data=b''
+        self.total=None
+        
+        # Boxes up to the codestream
+        self.lstBox=[]    # [type, start, length]
+        pos=0
+        while True:
+            self.Head(pos+16)
+            lbox,tbox=struct.unpack('>I4s',self.data[pos:pos+8])
+            hlen=8
+            if lbox==1: lbox,hlen=struct.unpack('>Q',self.data[pos+8:pos+16])[0],16
+            if tbox==b'jp2c': break
+            if not lbox: raise RuntimeError("JP2 codestream did not find : %s"% url)
+            self.lstBox.append([tbox,pos,lbox])
+            pos+=lbox
+        self.posCode=pos+hlen
+        self.Head(self.posCode)
+        self.origin,self.res,self.epsg=self.Georef()
+        
+        # Codestream main header
+        pos=self.posCode+2
+        self.lstSeg=[]    # [marker, segment bytes]
+        self.lstTlm=[]
+        while True:
+            self.Head(pos+4)
+            marker,length=struct.unpack('>HH',self.data[pos:pos+4])
+            if marker==0xFF90: break
+            self.Head(pos+2+length)
+            seg=self.data[pos:pos+2+length]
+            if marker==0xFF51: self.siz=list(struct.unpack('>8I',seg[6:38]))
+            elif marker==0xFF52: self.nbLevel=seg[9]
+            elif marker==0xFF55: self.lstTlm.append(seg)
+            elif marker in (0xFF60,0xFF57): raise RuntimeError("JP2 packed packet headers not supported : %s"% url)
+            self.lstSeg.append([marker,seg])
+            pos+=2+length
+        self.posTile=pos
+        
+        [Xsiz,Ysiz,XOsiz,YOsiz,XTsiz,YTsiz,XTOsiz,YTOsiz]=self.siz
+        self.nbX=-(-(Xsiz-XTOsiz)//XTsiz)
+        self.nbY=-(-(Ysiz-YTOsiz)//YTsiz)
+        self.lstPart=self.TileParts()
+    
+    def Head(self,size):
+        '''Make sure the first size bytes of the file are read'''
+        while len(self.data)<size:
+            content,self.total=self.transport.ReadRange(self.url,len(self.data),len(self.data)+max(sizeHeadJp2,size-len(self.data))-1)
+            if not content: raise RuntimeError("JP2 file truncated : %s"% self.url)
+            self.data+=content
+    
+    def Georef(self):
+        '''Upper-left pixel centre, pixel size and EPSG code from the GMLJP2 box, None if missing'''
+        matchOrig=re.search(rb'<gml:origin>.*?<gml:pos>\s*(\S+)\s+(\S+)\s*</gml:pos>',self.data[:self.posCode],re.S)
+        matchRes=re.search(rb'<gml:offsetVector[^>]*>\s*(\S+)\s+\S+\s*</gml:offsetVector>',self.data[:self.posCode])
+        matchSrs=re.search(rb'srsName="[^"]*EPSG[^"]*?(\d+)"',self.data[:self.posCode])
+        if not matchOrig or not matchRes: return None,None,None
+        return [float(matchOrig.group(1)),float(matchOrig.group(2))],abs(float(matchRes.group(1))),int(matchSrs.group(1)) if matchSrs else None
+    
+    def MapBox(self,window):
+        '''Window [lonmin,latmin,lonmax,latmax] (WGS84 degrees) in map coordinates of the band, box of its projected corners and edge middles'''
+        if self.epsg is None or not self.epsg//100 in (326,327): raise RuntimeError("JP2 projection not supported (EPSG %s) : %s"% (self.epsg,self.url))
+        lstPoint=[LonLatToUtm(lon,lat,self.epsg%100,self.epsg//100==326) for lon in (window[0],(window[0]+window[2])/2,window[2]) for lat in (window[1],(window[1]+window[3])/2,window[3])]
+        return [min(point[0] for point in lstPoint),min(point[1] for point in lstPoint),max(point[0] for point in lstPoint),max(point[1] for point in lstPoint)]
+    
+    def TileParts(self):
+        '''List of tile-parts [tile, part, start, length] in file order'''
+        lstPart=[]
+        if self.lstTlm:
+            pos,dicNb=self.posTile,{}
+            for seg in self.lstTlm:
+                st,sp=(seg[5]>>4)&3,(seg[5]>>6)&1
+                sizeEntry=st+(4 if sp else 2)
+                for k in range(6,len(seg),sizeEntry):
+                    tile=int.from_bytes(seg[k:k+st],'big') if st else len(lstPart)
+                    length=int.from_bytes(seg[k+st:k+sizeEntry],'big')
+                    lstPart.append([tile,dicNb.get(tile,0),pos,length])
+                    dicNb[tile]=dicNb.get(tile,0)+1
+                    pos+=length
+            return lstPart
+        
+        # SOT walk, one small range request per tile-part beyond the head
+        pos=self.posTile
+        while True:
+            if pos+12<=len(self.data):
+                head=self.data[pos:pos+12]
+            else:
+                head,self.total=self.transport.ReadRange(self.url,pos,pos+11)
+            if not head[:2]==b'\xff\x90': break
+            tile,length,part=struct.unpack('>HIB',head[4:11])
+            if not length: length=self.total-2-pos
+            lstPart.append([tile,part,pos,length])
+            pos+=length
+        return lstPart
+    
+    def Write(self,pathOut,window=None,reduce=0,commit=True):
+        '''
+        Write the JP2 file of the tiles covering window [lonmin,latmin,lonmax,
+        latmax] (WGS84 degrees, projected on the band, MapBox), whole image 
+        if None, without the 
+        reduce highest resolution levels (read it with a reduce factor). 
+        The image is cropped to these tiles and georeferenced by a .j2w 
+        world file. Without commit, the band stays a .part file (see 
+        CommitFile). Returns the number of bytes read.
+        '''
+        [Xsiz,Ysiz,XOsiz,YOsiz,XTsiz,YTsiz,XTOsiz,YTOsiz]=self.siz
+        p0,p1,q0,q1=0,self.nbX-1,0,self.nbY-1
+        if window:
+            if self.origin is None: raise RuntimeError("JP2 georeference did not find : %s"% self.url)
+            box=self.MapBox(window)
+            colMin=XOsiz+math.floor((box[0]-self.origin[0])/self.res+0.5)
+            colMax=XOsiz+math.ceil((box[2]-self.origin[0])/self.res+0.5)
+            rowMin=YOsiz+math.floor((self.origin[1]-box[3])/self.res+0.5)
+            rowMax=YOsiz+math.ceil((self.origin[1]-box[1])/self.res+0.5)
+            colMin,colMax=max(colMin,XOsiz),min(colMax,Xsiz)
+            rowMin,rowMax=max(rowMin,YOsiz),min(rowMax,Ysiz)
+            if colMin>=colMax or rowMin>=rowMax: raise RuntimeError("Window out of the band : %s"% self.url)
+            p0,p1=(colMin-XTOsiz)//XTsiz,(colMax-1-XTOsiz)//XTsiz
+            q0,q1=(rowMin-YTOsiz)//YTsiz,(rowMax-1-YTOsiz)//YTsiz
+        
+        # Tile-parts kept, resolution levels need one tile-part per level
+        dicNb={}
+        for part in self.lstPart: dicNb[part[0]]=dicNb.get(part[0],0)+1
+        nbPartKeep=None
+        if reduce:
+            if set(dicNb.values())=={self.nbLevel+1}:
+                nbPartKeep=self.nbLevel+1-min(reduce,self.nbLevel)
+            else:
+                print("--Resolution levels not split in tile-parts, whole tiles kept : %s"% self.url)
+        lstKeep=[part for part in self.lstPart if p0<=part[0]%self.nbX<=p1 and q0<=part[0]//self.nbX<=q1 and (nbPartKeep is None or part[1]<nbPartKeep)]
+        
+        # New image area on the tiles kept
+        crop=not (p0,p1,q0,q1)==(0,self.nbX-1,0,self.nbY-1)
+        sizNew=[min(Xsiz,XTOsiz+(p1+1)*XTsiz),min(Ysiz,YTOsiz+(q1+1)*YTsiz),max(XOsiz,XTOsiz+p0*XTsiz),max(YOsiz,YTOsiz+q0*YTsiz),XTsiz,YTsiz,XTOsiz+p0*XTsiz,YTOsiz+q0*YTsiz]
+        
+        nbRead=0
+        with open(pathOut+'.part','wb') as fileOut:
+            for tbox,start,lbox in self.lstBox:
+                box=self.data[start:start+lbox]
+                if crop and not tbox in (b'jP  ',b'ftyp',b'jp2h'): continue
+                if crop and tbox==b'jp2h':
+                    k=box.index(b'ihdr')+4
+                    box=box[:k]+struct.pack('>II',sizNew[1]-sizNew[3],sizNew[0]-sizNew[2])+box[k+8:]
+                fileOut.write(box)
+            fileOut.write(struct.pack('>I4s',0,b'jp2c')+b'\xff\x4f')
+            for marker,seg in self.lstSeg:
+                if marker==0xFF55: continue
+                if marker==0xFF51 and crop: seg=seg[:6]+struct.pack('>8I',*sizNew)+seg[38:]
+                fileOut.write(seg)
+            
+            # Contiguous tile-parts read together
+            lstSpan=[]
+            for part in lstKeep:
+                if lstSpan and lstSpan[-1][-1][2]+lstSpan[-1][-1][3]==part[2] and part[2]+part[3]-lstSpan[-1][0][2]<=sizeSpanJp2:
+                    lstSpan[-1].append(part)
+                else:
+                    lstSpan.append([part])
+            
+            for span in lstSpan:
+                start=span[0][2]
+                content,self.total=self.transport.ReadRange(self.url,start,span[-1][2]+span[-1][3]-1)
+                nbRead+=len(content)
+                for tile,part,pos,length in span:
+                    tilePart=content[pos-start:pos-start+length]
+                    isot=(tile//self.nbX-q0)*(p1-p0+1)+tile%self.nbX-p0
+                    tnsot=tilePart[11] if nbPartKeep is None else 0
+                    fileOut.write(tilePart[:4]+struct.pack('>H',isot)+tilePart[6:11]+bytes([tnsot])+tilePart[12:])
+            fileOut.write(b'\xff\xd9')
+        
+        # world file first, the band is there once both are
+        if crop and self.origin:
+            pathWorld=os.path.splitext(pathOut)[0]+'.j2w'
+            with open(pathWorld+'.part','w') as fileOut:
+                fileOut.write('%f\n0\n0\n%f\n%f\n%f\n'% (self.res,-self.res,self.origin[0]+(sizNew[2]-XOsiz)*self.res,self.origin[1]-(sizNew[3]-YOsiz)*self.res))
+            CommitFile(pathWorld+'.part',pathWorld)
+        CommitFile(pathOut+'.part',pathOut,commit=commit)
+        
+        return len(self.data)+nbRead
+
+#----------------------------------------------------------------------------------------------------
+# Cache
+#----------------------------------------------------------------------------------------------------
+class Cache:
+    '''
+    On-disk catalogue (SQLite) of OpenSearch answers keyed by tile, date 
+    and level ([title,id,url]) and of the band paths read in the product 
+    Xml file (ReadS2XML) keyed by title. Entries older than ttl days are 
+    dropped at opening, then only the nbMax last used ones are kept.
+    '''
+    def __init__(self,pathFile,ttl=ttlCache,nbMax=nbCacheMax):
+        self.conn=sqlite3.connect(pathFile,check_same_thread=False)
+        self.lock=threading.Lock()
+        self.ttl=ttl*86400
+        self.nbMax=nbMax
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS product (tile TEXT, date TEXT, level TEXT, title TEXT, ident TEXT, url TEXT, stamp REAL, used REAL, PRIMARY KEY (tile,date,level))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS band (title TEXT PRIMARY KEY, paths TEXT, stamp REAL, used REAL)')
+        self.Evict()
+    
+    def Evict(self):
+        with self.lock, self.conn:
+            for table in ('product','band'):
+                self.conn.execute('DELETE FROM %s WHERE stamp<?'% table,(time.time()-self.ttl,))
+                self.conn.execute('DELETE FROM %s WHERE rowid NOT IN (SELECT rowid FROM %s ORDER BY used DESC LIMIT ?)'% (table,table),(self.nbMax,))
+    
+    def GetProduct(self,tile,date,level):
+        '''Returns [title,id,url] or None'''
+        key=(tile,strftime('%Y%m%d',date),level)
+        with self.lock, self.conn:
+            row=self.conn.execute('SELECT title,ident,url FROM product WHERE tile=? AND date=? AND level=?',key).fetchone()
+            if row: self.conn.execute('UPDATE product SET used=? WHERE tile=? AND date=? AND level=?',(time.time(),)+key)
+        if row: return list(row)
+        return None
+    
+    def PutProduct(self,tile,date,level,lstRes):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO product VALUES (?,?,?,?,?,?,?,?)',(tile,strftime('%Y%m%d',date),level)+tuple(lstRes[:3])+(time.time(),time.time()))
+    
+    def GetBands(self,title):
+        '''Returns the band paths {band: relative path} or None'''
+        with self.lock, self.conn:
+            row=self.conn.execute('SELECT paths FROM band WHERE title=?',(title,)).fetchone()
+            if row: self.conn.execute('UPDATE band SET used=? WHERE title=?',(time.time(),title))
+        if row: return json.loads(row[0])
+        return None
+    
+    def PutBands(self,title,dico):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO band VALUES (?,?,?,?)',(title,json.dumps(dico),time.time(),time.time()))
+    
+    def Close(self):
+        self.conn.close()
+
+class TileGrid:
+    '''
+    Index (SQLite) of the military grid: centroide and footprint of every 
+    tile. It is built once from the ESA kml (Build) then each lookup is a 
+    primary key read, no network fetch nor kml parsing at startup.
+    '''
+    def __init__(self,pathFile):
+        self.conn=sqlite3.connect(pathFile)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS grid (tile TEXT PRIMARY KEY, lon REAL, lat REAL, footprint TEXT)')
+    
+    def IsEmpty(self):
+        return not self.conn.execute('SELECT COUNT(*) FROM grid').fetchone()[0]
+    
+    def Build(self,lstUrlKml):
+        '''(Re)fill the index from the kml'''
+        print('-- Tile index from %s'% lstUrlKml[0])
+        with self.conn:
+            self.conn.execute('DELETE FROM grid')
+            self.conn.executemany('INSERT OR REPLACE INTO grid VALUES (?,?,?,?)',((nameTile,center[0],center[1],json.dumps(lstPoly)) for nameTile,center,lstPoly in ParseKml(lstUrlKml)))
+        print('-- %i tiles indexed'% self.conn.execute('SELECT COUNT(*) FROM grid').fetchone()[0])
+    
+    def Centers(self,lstTile):
+        '''
+        Returns {tile: [lon,lat]}. Unknown tiles raise an error, the index 
+        is only rebuilt on request (-refreshgrid), a mistyped tile does 
+        not fetch the kml again.
+        '''
+        dicCenter={}
+        for nameTile in set(lstTile):
+            row=self.conn.execute('SELECT lon,lat FROM grid WHERE tile=?',(nameTile,)).fetchone()
+            if row: dicCenter[nameTile]=list(row)
+        
+        lstMissing=[nameTile for nameTile in lstTile if not nameTile in dicCenter]
+        if lstMissing: raise RuntimeError("Tile did not find (-refreshgrid to rebuild the index) : %s"% ' '.join(lstMissing))
+        return dicCenter
+    
+    def Footprints(self,lstTile):
+        '''Returns {tile: polygons [[[lon,lat],..],..]} of the known tiles'''
+        dicPoly={}
+        for nameTile in set(lstTile):
+            row=self.conn.execute('SELECT footprint FROM grid WHERE tile=?',(nameTile,)).fetchone()
+            if row: dicPoly[nameTile]=json.loads(row[0])
+        return dicPoly
+    
+    def Close(self):
+        self.conn.close()
+
+#----------------------------------------------------------------------------------------------------
+# Run statistics
+#----------------------------------------------------------------------------------------------------
+class RunStats:
+    '''
+    Instrumentation of a run: busy time per stage (kml, grid, query, xml, 
+    band, prod, window), one record per transfer (bytes, duration, 
+    throughput, retries), hub latency histogram (request sent to response 
+    headers, native transport) and tile counts. Report writes it to JSON or 
+    CSV, Line gives the live progress line.
+    '''
+    lstBucket=[0.1,0.25,0.5,1,2,5,10,30,60]
+    
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.local=threading.local()
+        self.start=time.time()
+        self.dicStage={}   # stage: [seconds, count]
+        self.lstFile=[]    # [kind, name, bytes, seconds, retries, status]
+        self.lstLatency=[0]*(len(self.lstBucket)+1)
+        self.nbRetry=0
+        self.nbByte=0
+        self.dicTile={'row': 0, 'done': 0, 'ok': 0}
+    
+    @contextmanager
+    def Stage(self,name):
+        start=time.time()
+        try:
+            yield
+        finally:
+            self.AddStage(name,time.time()-start)
+    
+    def AddStage(self,name,seconds):
+        with self.lock:
+            if not name in self.dicStage: self.dicStage[name]=[0.0,0]
+            self.dicStage[name][0]+=seconds
+            self.dicStage[name][1]+=1
+    
+    def BeginFile(self):
+        '''Reset the retry count of the transfer run by the current thread'''
+        self.local.retry=0
+    
+    def AddFile(self,kind,name,nbByte,seconds,returnCode):
+        with self.lock:
+            self.lstFile.append([kind,name,nbByte,seconds,getattr(self.local,'retry',0),'ok' if not returnCode else 'issue'])
+            self.nbByte+=nbByte
+        self.AddStage(kind,seconds)
+    
+    def AddLatency(self,seconds):
+        k=0
+        while k<len(self.lstBucket) and seconds>self.lstBucket[k]: k+=1
+        with self.lock:
+            self.lstLatency[k]+=1
+    
+    def AddRetry(self):
+        self.local.retry=getattr(self.local,'retry',0)+1
+        with self.lock:
+            self.nbRetry+=1
+    
+    def Summary(self):
+        with self.lock:
+            wall=time.time()-self.start
+            return {'start': strftime("%Y-%m-%dT%H:%M:%S",localtime(self.start)),
+                'wall': wall,
+                'tiles': dict(self.dicTile),
+                'bytes': self.nbByte,
+                'throughput': self.nbByte/wall if wall else 0.0,
+                'retries': self.nbRetry,
+                'stages': dict((name,{'seconds': val[0], 'count': val[1]}) for name,val in self.dicStage.items()),
+                'latency': {'buckets': self.lstBucket+['inf'], 'counts': list(self.lstLatency)},
+                'files': [{'kind': kind, 'name': name, 'bytes': nbByte, 'seconds': seconds, 'throughput': nbByte/seconds if seconds else 0.0, 'retries': retry, 'status': status} for kind,name,nbByte,seconds,retry,status in self.lstFile]}
+    
+    def Report(self,pathFile):
+        '''
+        Write the run report, JSON or CSV (one row for the run, per stage, 
+        per latency bucket then per transfer) from the extension. CSV 
+        columns keep their meaning on every row: count is the number of 
+        stage calls, requests or transfers, tiles and rows the tiles 
+        correctly done and the rows read (run row).
+        '''
+        dicSum=self.Summary()
+        if pathFile.endswith('.csv'):
+            with open(pathFile,'w',newline='') as fileOut:
+                writer=csv.writer(fileOut)
+                writer.writerow(['kind','name','bytes','seconds','throughput','retries','status','count','tiles','rows'])
+                writer.writerow(['run','wall',dicSum['bytes'],'%.3f'% dicSum['wall'],'%.1f'% dicSum['throughput'],dicSum['retries'],'',len(dicSum['files']),dicSum['tiles']['ok'],dicSum['tiles']['row']])
+                for name,dicVal in dicSum['stages'].items():
+                    writer.writerow(['stage',name,'','%.3f'% dicVal['seconds'],'','','',dicVal['count'],'',''])
+                for bucket,count in zip(dicSum['latency']['buckets'],dicSum['latency']['counts']):
+                    writer.writerow(['latency','<=%s'% bucket,'','','','','',count,'',''])
+                for dicFile in dicSum['files']:
+                    writer.writerow([dicFile['kind'],dicFile['name'],dicFile['bytes'],'%.3f'% dicFile['seconds'],'%.1f'% dicFile['throughput'],dicFile['retries'],dicFile['status'],1,'',''])
+        else:
+            with open(pathFile,'w') as fileOut:
+                json.dump(dicSum,fileOut,indent=1)
+    
+    def Line(self):
+        with self.lock:
+            wall=time.time()-self.start
+            return '-- %i/%i tiles done | %.1f MB | %.2f MB/s | %i retries | %is'% (self.dicTile['done'],self.dicTile['row'],self.nbByte/1e6,self.nbByte/1e6/wall if wall else 0.0,self.nbRetry,wall)
+
+def ProgressLoop(stats,event,period=2.0):
+    '''Print the live progress line on stderr until event is set'''
+    while not event.wait(period):
+        sys.stderr.write(stats.Line()+'\n')
+    sys.stderr.write(stats.Line()+'\n')
+
+#----------------------------------------------------------------------------------------------------
+# Download scheduler
+#----------------------------------------------------------------------------------------------------
+class HostLimit:
+    '''
+    Transfer slots of one host. When the host pushes back (429, 503) the 
+    limit is halved and the host is held for the delay, then it grows back 
+    by one slot each time limit transfers succeed in a row.
+    '''
+    def __init__(self,nbMax):
+        self.nbMax=nbMax
+        self.limit=nbMax
+        self.active=0
+        self.nbOk=0
+        self.until=0.0
+        self.cond=threading.Condition()
+    
+    def __enter__(self):
+        with self.cond:
+            while self.active>=self.limit or time.time()<self.until:
+                self.cond.wait(max(0.01,self.until-time.time()) if time.time()<self.until else None)
+            self.active+=1
+        return self
+    
+    def __exit__(self,*exc):
+        with self.cond:
+            self.active-=1
+            self.cond.notify_all()
+    
+    def Extra(self,nb):
+        '''Take up to nb more slots without waiting (split ranges), returns the number taken'''
+        with self.cond:
+            if time.time()<self.until: return 0
+            nbTaken=max(0,min(nb,self.limit-self.active))
+            self.active+=nbTaken
+            return nbTaken
+    
+    def Give(self,nb):
+        '''Give back nb slots taken by Extra'''
+        if not nb: return
+        with self.cond:
+            self.active-=nb
+            self.cond.notify_all()
+    
+    def Throttle(self,delay):
+        with self.cond:
+            self.limit=max(1,self.limit//2)
+            self.nbOk=0
+            self.until=max(self.until,time.time()+delay)
+    
+    def Success(self):
+        with self.cond:
+            if self.limit==self.nbMax: return
+            self.nbOk+=1
+            if self.nbOk>=self.limit:
+                self.limit+=1
+                self.nbOk=0
+                self.cond.notify_all()
+
+class DownloadPool:
+    '''
+    Bounded worker pool running download commands. Each host gets its own 
+    slots so the number of simultaneous transfers on the hub stays under 
+    nbPerHost whatever the number of workers (less while the hub pushes 
+    back). Transient failures are retried nbRetry times, the ones failed 
+    for good are kept in lstFailed.
+    '''
+    def __init__(self,transport,nbJobs,nbPerHost,stats=None,nbRetry=nbRetry):
+        self.transport=transport
+        self.executor=ThreadPoolExecutor(max_workers=nbJobs)
+        self.nbJobs=nbJobs
+        self.nbPerHost=nbPerHost
+        self.nbRetry=nbRetry
+        self.dicHost={}
+        self.lock=threading.Lock()
+        self.pourcent=0.0
+        self.lstFailed=[]   # [kind, name, reason, attempts]
+        self.stats=stats
+        self.transport.stats=stats
+    
+    def Host(self,url):
+        host=urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if not host in self.dicHost: self.dicHost[host]=HostLimit(self.nbPerHost)
+            return self.dicHost[host]
+    
+    def Retry(self,url,kind,name,fct,stop=None):
+        '''
+        Call fct() on a slot of the url host until it returns 0 (2 for a 
+        failure not worth a retry). Network errors, truncated bodies and 
+        setRetry status are tried again after an exponential backoff with 
+        jitter, or the Retry-After of the hub (429 and 503 also throttle the 
+        host). Returns the last code, codeOffline if the hub answered 202 
+        (offline product, see Archive).
+        '''
+        host=self.Host(url)
+        for k in range(self.nbRetry+1):
+            self.transport.Failure()
+            with host:
+                returnCode=fct()
+            if not returnCode:
+                host.Success()
+                return 0
+            
+            status,retryAfter=self.transport.Failure()
+            if status==202: return codeOffline
+            if stop and stop.is_set(): return returnCode
+            if returnCode==2 or (status is not None and not status in setRetry): break
+            if k==self.nbRetry: break
+            delay=min(delayRetryMax,delayRetry*2**k)*random.uniform(0.5,1.0)
+            if retryAfter is not None: delay=min(delayRetryMax,retryAfter)
+            if status in (429,503): host.Throttle(delay)
+            if self.stats: self.stats.AddRetry()
+            print("--Retry %i/%i in %.1fs (%s) : %s"% (k+1,self.nbRetry,delay,status or 'error',name))
+            if stop:
+                if stop.wait(delay): return returnCode
+            else:
+                time.sleep(delay)
+        
+        with self.lock:
+            self.lstFailed.append([kind,name,'HTTP %i'% status if status else 'error',k+1])
+        return returnCode
+    
+    def Run(self,outFolder,fileName,url,nbSplit=1,md5=None,stop=None,kind='file',commit=True):
+        '''
+        Download url to outFolder/fileName. md5 is the expected checksum, 
+        True to ask it to the hub (OData Checksum of the product), a 
+        mismatching file is removed and downloaded again. kind names the 
+        transfer in the run statistics. Without commit, the file stays a 
+        checked .part file (see CommitFile). The split ranges run on the 
+        slots of the host free at the time, one each, their layout stays 
+        nbSplit so a retry resumes them.
+        '''
+        pathOut=os.path.join(outFolder,fileName)
+        host=self.Host(url)
+        if md5 is True:
+            content=self.Read(url[:-len('$value')]+'Checksum/Value/$value',kind='md5',stop=stop)
+            md5=None
+            if content: md5=content.decode().strip()
+            else: print("--MD5 not available : %s"% fileName)
+        
+        def Attempt():
+            # run in a slot of the host, the other ranges take one each
+            nbExtra=host.Extra(nbSplit-1) if nbSplit>1 else 0
+            try:
+                return self.transport.Fetch(url,outFolder,fileName,self.pourcent,nbSplit,stop,md5,commit,1+nbExtra)
+            finally:
+                host.Give(nbExtra)
+        
+        sizeBefore=SizePart(pathOut)
+        if self.stats: self.stats.BeginFile()
+        start=time.time()
+        returnCode=self.Retry(url,kind,fileName,Attempt,stop)
+        if self.stats: self.stats.AddFile(kind,fileName,max(0,SizePart(pathOut)-sizeBefore),time.time()-start,returnCode)
+        return returnCode
+    
+    def Read(self,url,kind='query',stop=None):
+        '''Download url in memory, returns the content or None'''
+        lstContent=[None]
+        def Attempt():
+            lstContent[0]=self.transport.Read(url)
+            return lstContent[0] is None
+        
+        if self.stats: self.stats.BeginFile()
+        start=time.time()
+        returnCode=self.Retry(url,kind,url,Attempt,stop)
+        if self.stats: self.stats.AddFile(kind,url,len(lstContent[0] or b''),time.time()-start,returnCode)
+        return lstContent[0]
+    
+    def RunWindow(self,outFolder,fileName,url,window=None,reduce=0,stop=None,commit=True):
+        '''Download the JPEG2000 tiles of url covering window, without the reduce highest levels (Jp2Window)'''
+        if not hasattr(self.transport,'ReadRange'):
+            print("--Band window needs the native download package")
+            return 1
+        pathOut=os.path.join(outFolder,fileName)
+        lstByte=[0]
+        def Attempt():
+            print("--%s-%.2f%%: GET %s %s/%i > %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),self.pourcent,url,window,reduce,pathOut))
+            try:
+                lstByte[0]+=Jp2Window(self.transport,url).Write(pathOut,window,reduce,commit)
+            except (RuntimeError,struct.error) as msg:
+                # codestream not supported
+                print("--JP2 window error %s : %s"% (msg,url))
+                return 2
+            except (http.client.HTTPException,OSError) as msg:
+                print("--JP2 window error %s : %s"% (msg,url))
+                return 1
+            return 0
+        
+        if self.stats: self.stats.BeginFile()
+        start=time.time()
+        returnCode=self.Retry(url,'window',fileName,Attempt,stop)
+        if self.stats: self.stats.AddFile('window',fileName,lstByte[0],time.time()-start,returnCode)
+        return returnCode
+    
+    def Order(self,url,stop=None):
+        '''Send the retrieval order of an offline product, returns the HTTP status (None if unknown)'''
+        with self.Host(url):
+            return self.transport.Order(url)
+    
+    def Submit(self,outFolder,fileName,url,nbSplit=1,md5=None,kind='file',commit=True):
+        return self.executor.submit(self.Run,outFolder,fileName,url,nbSplit,md5,None,kind,commit)
+    
+    def SubmitWindow(self,outFolder,fileName,url,window=None,reduce=0,commit=True):
+        return self.executor.submit(self.RunWindow,outFolder,fileName,url,window,reduce,None,commit)
+    
+    def Shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.transport.Close()
+
+class Archive:
+    '''
+    Products of the Long Term Archive (offline). Each one is ordered once 
+    (GET $value answers 202 Accepted and starts the retrieval), then its 
+    Online flag is polled every delayLta seconds until it can be downloaded 
+    or delayLtaMax is over. Orders refused by the hub (quota) are sent 
+    again at the next poll.
+    '''
+    def __init__(self,pool):
+        self.pool=pool
+        self.dicWait={}   # urlOD: [ordered, next poll, deadline]
+        self.lock=threading.Lock()
+    
+    def Add(self,urlOD,ordered=False):
+        with self.lock:
+            if not urlOD in self.dicWait: self.dicWait[urlOD]=[ordered,time.time()+delayLta,time.time()+delayLtaMax]
+    
+    def Waiting(self,urlOD):
+        with self.lock:
+            return urlOD in self.dicWait
+    
+    def Send(self,urlOD,stop=None):
+        '''Order the retrieval of urlOD'''
+        status=self.pool.Order(urlOD,stop)
+        print("--LTA order (%s) : %s"% (status,urlOD))
+        with self.lock:
+            if urlOD in self.dicWait: self.dicWait[urlOD][0]=status in (200,202,206)
+    
+    def Due(self):
+        '''Products whose poll time has come (set aside until Check)'''
+        with self.lock:
+            lstUrl=[urlOD for urlOD,lstVal in self.dicWait.items() if lstVal[1]<=time.time()]
+            for urlOD in lstUrl: self.dicWait[urlOD][1]=float('inf')
+        return lstUrl
+    
+    def Check(self,urlOD,stop=None):
+        '''Poll urlOD once, returns online, offline (next poll in delayLta s) or expired'''
+        with self.lock:
+            # polled by another waiter meanwhile
+            if not urlOD in self.dicWait: return 'online'
+            ordered,_,deadline=self.dicWait[urlOD]
+        if not ordered: self.Send(urlOD,stop)
+        content=self.pool.Read(urlOD[:-len('$value')]+'Online/$value','online',stop)
+        with self.lock:
+            if content and content.strip().lower()==b'true':
+                del self.dicWait[urlOD]
+                return 'online'
+            if time.time()>deadline:
+                del self.dicWait[urlOD]
+                return 'expired'
+            self.dicWait[urlOD][1]=time.time()+delayLta
+        return 'offline'
+
+class DiskPlanner:
+    '''
+    Disk space of the run. Before its downloads start, each tile reserves 
+    the volume it still needs (Need: hub product size, share of its bands, 
+    files already there left out) on the volume of its output folder. A 
+    volume takes tiles while sizeFreeMin bytes stay free (free space read 
+    at its first tile) and, with a budget, while the run stays under budget 
+    bytes. Reservations of failed tiles are given back.
+    '''
+    def __init__(self,budget=None):
+        self.budget=budget
+        self.used=0
+        self.dicSize={}     # product url: [size from the hub (bytes), rows still to finish]
+        self.dicVolume={}   # device: [free at start, reserved]
+        self.dicTile={}     # tile key: [device, reserved]
+        self.freed=False
+        self.lock=threading.Lock()
+    
+    def SetSize(self,urlOD,size):
+        with self.lock:
+            if urlOD in self.dicSize: self.dicSize[urlOD][1]+=1
+            else: self.dicSize[urlOD]=[size,1]
+    
+    def Forget(self,urlOD):
+        '''A row of urlOD is over, its size is dropped with the last one'''
+        with self.lock:
+            if not urlOD in self.dicSize: return
+            self.dicSize[urlOD][1]-=1
+            if not self.dicSize[urlOD][1]: del self.dicSize[urlOD]
+    
+    def Need(self,tilesStuff):
+        '''Bytes the tile still has to download, None if the product size is unknown'''
+        [nameTile,dateTile,levelTile,bandsTile,outTile,titleTile,identTile,urlODTile]=tilesStuff[:8]
+        size=tilesStuff[9] if len(tilesStuff)>9 else self.dicSize.get(urlODTile,[None])[0]
+        if not size: return None
+        if bandsTile=='prod': return max(0,size-SizePart(os.path.join(outTile,titleTile+'.zip')))
+        repOut=os.path.join(outTile,'%s'% titleTile)
+        return sum(int(size*lstShareBand[bandNum]) for bandNum in bandsTile if not os.path.exists(os.path.join(repOut,titleTile+'_B%02i.jp2'% bandNum)))
+    
+    def Room(self,outFolder):
+        '''Bytes the run can still write to the volume of outFolder'''
+        device=os.stat(outFolder).st_dev
+        with self.lock:
+            if not device in self.dicVolume:
+                free=shutil.disk_usage(outFolder).free
+                self.dicVolume[device]=[free,0]
+                print("-- Disk %s : %.2f GB free%s"% (outFolder,free/1e9,', budget %.2f GB'% (self.budget/1e9) if self.budget is not None else ''))
+            free,reserved=self.dicVolume[device]
+            room=free-sizeFreeMin-reserved
+            if self.budget is not None: room=min(room,self.budget-self.used)
+            return room
+    
+    def Reserve(self,key,outFolder,nbByte):
+        '''Reserve nbByte for tile key on the volume of outFolder, False if there is no room'''
+        if nbByte>self.Room(outFolder): return False
+        device=os.stat(outFolder).st_dev
+        with self.lock:
+            self.dicVolume[device][1]+=nbByte
+            self.used+=nbByte
+            self.dicTile[key]=[device,nbByte]
+        return True
+    
+    def Release(self,key,failed=False):
+        '''Tile key is over, its reservation is given back if it failed'''
+        with self.lock:
+            if not key in self.dicTile: return
+            device,nbByte=self.dicTile.pop(key)
+            if not failed: return
+            self.dicVolume[device][1]-=nbByte
+            self.used-=nbByte
+            self.freed=True
+
+#----------------------------------------------------------------------------------------------------
+# Post-processing
+#----------------------------------------------------------------------------------------------------
+def CheckZip(path,full=False):
+    '''Issue of a downloaded zip (truncated: no central directory, full: CRC of each member) or None'''
+    try:
+        with zipfile.ZipFile(path) as fileZip:
+            if full:
+                nameBad=fileZip.testzip()
+                if nameBad: return 'bad CRC %s'% nameBad
+    except (zipfile.BadZipFile,OSError) as msg:
+        return 'truncated zip (%s)'% msg
+    return None
+
+def CheckJp2(path):
+    '''Issue of a downloaded JPEG2000 band (signature box at the start, EOC marker at the end) or None'''
+    with open(path,'rb') as fileIn:
+        head=fileIn.read(12)
+        fileIn.seek(max(0,os.path.getsize(path)-2))
+        tail=fileIn.read(2)
+    if not head==b'\x00\x00\x00\x0cjP  \r\n\x87\n' and not head[:2]==b'\xff\x4f': return 'not a JPEG2000 file'
+    if not tail==b'\xff\xd9': return 'truncated JPEG2000 (no EOC marker)'
+    return None
+
+def PostFile(path,kind,md5=None,fullZip=False,cog=False):
+    '''
+    Check a downloaded file in a worker process while it is still its 
+    .part file (downloaded without commit): MD5 if given, zip (kind prod) 
+    or JPEG2000 (kind band) structure, then commit it to path and convert 
+    a band to Cloud Optimised GeoTIFF next to it if cog. Returns the issue 
+    or None, a file with issue is removed (downloaded again by the next 
+    run) and never shows at path.
+    '''
+    pathCheck=path+'.part' if os.path.exists(path+'.part') else path
+    msg=None
+    if md5 and not Md5File(pathCheck).lower()==md5.lower(): msg='MD5 mismatch'
+    elif kind=='prod': msg=CheckZip(pathCheck,fullZip)
+    elif kind=='band': msg=CheckJp2(pathCheck)
+    if msg:
+        os.remove(pathCheck)
+        return '%s : %s'% (msg,os.path.basename(path))
+    if not pathCheck==path: CommitFile(pathCheck,path)
+    
+    if cog and kind=='band':
+        pathTif=os.path.splitext(path)[0]+'.tif'
+        gdal.UseExceptions()
+        try:
+            gdal.Translate(pathTif+'.part',path,format='COG',creationOptions=['COMPRESS=DEFLATE','PREDICTOR=2','BIGTIFF=IF_SAFER'])
+            CommitFile(pathTif+'.part',pathTif)
+        except RuntimeError as err:
+            return 'COG conversion error %s : %s'% (err,os.path.basename(path))
+    return None
+
+def PostStack(lstPath,pathOut):
+    '''Stack bands (finest resolution) to one Cloud Optimised GeoTIFF in a worker process, returns the issue or None'''
+    gdal.UseExceptions()
+    try:
+        vrt=gdal.BuildVRT('',lstPath,separate=True,resolution='highest')
+        gdal.Translate(pathOut+'.part',vrt,format='COG',creationOptions=['COMPRESS=DEFLATE','PREDICTOR=2','BIGTIFF=IF_SAFER'])
+        vrt=None
+        CommitFile(pathOut+'.part',pathOut)
+    except RuntimeError as err:
+        return 'Stack error %s : %s'% (err,os.path.basename(pathOut))
+    return None
+
+class PostPool:
+    '''
+    Process pool checking the downloaded files (PostFile) and stacking the 
+    bands of each tile (PostStack), nbProc processes working while the 
+    downloads go on. Conversion and stack need GDAL Python bindings. The 
+    processes are spawned, not forked: the pool starts them lazily, once 
+    the pipeline threads hold their locks.
+    '''
+    def __init__(self,nbProc,fullZip=False,cog=False,stack=False):
+        if (cog or stack) and gdal is None: raise RuntimeError("GDAL Python bindings (osgeo) needed for the conversion to COG")
+        self.executor=ProcessPoolExecutor(max_workers=nbProc,mp_context=multiprocessing.get_context('spawn'))
+        self.fullZip=fullZip
+        self.cog=cog
+        self.stack=stack
+    
+    def Submit(self,path,kind,md5=None):
+        return self.executor.submit(PostFile,path,kind,md5,self.fullZip,self.cog)
+    
+    def SubmitStack(self,lstPath,pathOut):
+        return self.executor.submit(PostStack,lstPath,pathOut)
+    
+    def Shutdown(self):
+        self.executor.shutdown(wait=True)
+
+#----------------------------------------------------------------------------------------------------
+# Pipeline
+#----------------------------------------------------------------------------------------------------
+def PutStage(queueOut,item,stop=None):
+    '''Put item in queueOut, given up if stop is set meanwhile (failed stage): returns False then'''
+    while not (stop and stop.is_set()):
+        try:
+            queueOut.put(item,timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def ReadStage(iterRows,queueQuery,queueProd,dicCount,cache=None,stop=None):
+    '''
+    First stage: rows from the list go to the query stage, rows already 
+    resolved (meta4, cache) go straight to the download stage. Reading 
+    ends early once stop is set.
+    '''
+    try:
+        for tilesStuff in iterRows:
+            if stop and stop.is_set(): break
+            dicCount['row']+=1
+            if len(tilesStuff)<8 and cache:
+                lstRes=cache.GetProduct(*tilesStuff[:3])
+                if lstRes: tilesStuff+=lstRes
+            
+            if len(tilesStuff)>=8:
+                PutStage(queueProd,tilesStuff,stop)
+            else:
+                dicCount['query']+=1
+                PutStage(queueQuery,tilesStuff,stop)
+    except Exception as msg:
+        dicCount['error']=msg
+    finally:
+        PutStage(queueQuery,None,stop)
+
+def QueryStage(pool,queueQuery,queueProd,dicCount,pathGrid,refreshGrid=False,cache=None,archive=None,planner=None,stop=None):
+    '''
+    Second stage: rows sharing date and level are gathered in groups of 
+    nbTileQuery tiles, each full group is queried at once (idle input or 
+    end of list flush the open groups) and resolved rows go on to the 
+    download stage while the following rows are still read. Offline 
+    products are ordered to the archive as soon as they are found, product 
+    sizes go to the planner. An error sets stop: the other stages end 
+    instead of waiting on the queues.
+    '''
+    grid=None
+    dicCenter={}
+    dicSample={}  # tile: footprint samples
+    dicGroup={}   # (date, level): [date, rows]
+    dicQuery={}   # future: rows
+    executor=ThreadPoolExecutor(max_workers=pool.nbJobs)
+    Stage=pool.stats.Stage if pool.stats else lambda name: nullcontext()
+    
+    def Flush(key):
+        dateTile,lstRow=dicGroup.pop(key)
+        lstName=[]
+        for tilesStuff in lstRow:
+            if not tilesStuff[0] in lstName: lstName.append(tilesStuff[0])
+        
+        # in-flight queries limited to the pool size
+        while len(dicQuery)>=pool.nbJobs: Collect(None)
+        fut=executor.submit(QueryGroup,pool,lstName,dateTile,key[1],dicCenter,dicSample,stop)
+        dicQuery[fut]=lstRow
+    
+    def Collect(timeout=0,mode=FIRST_COMPLETED):
+        '''Pass the rows of finished queries on, waiting up to timeout (None for ever)'''
+        setDone,_=wait(dicQuery,timeout=timeout,return_when=mode)
+        for fut in setDone:
+            lstRow=dicQuery.pop(fut)
+            dicResolved=fut.result()
+            for tilesStuff in lstRow:
+                [nameTile,dateTile,levelTile,bandsTile,outTile]=tilesStuff
+                if not nameTile in dicResolved: 
+                    print("--Tile did not find : %s-%s"% (strftime('%Y%m%d',dateTile),nameTile))
+                    continue
+                [titleTile,identTile,urlODTile,online,size]=dicResolved[nameTile]
+                tilesStuff+=[titleTile,identTile,urlODTile]
+                if planner and size: planner.SetSize(urlODTile,size)
+                if cache: cache.PutProduct(nameTile,dateTile,levelTile,tilesStuff[5:8])
+                if archive and not online and not archive.Waiting(urlODTile):
+                    archive.Add(urlODTile)
+                    executor.submit(archive.Send,urlODTile)
+                PutStage(queueProd,tilesStuff,stop)
+    
+    try:
+        if refreshGrid:
+            grid=TileGrid(pathGrid)
+            with Stage('kml'): grid.Build(urlGrid)
+        
+        while True:
+            try:
+                tilesStuff=queueQuery.get(timeout=0.5)
+            except queue.Empty:
+                if stop and stop.is_set(): break
+                # idle input, open groups are sent
+                for key in list(dicGroup): Flush(key)
+                Collect()
+                continue
+            if tilesStuff is None: break
+            
+            [nameTile,dateTile,levelTile,bandsTile,outTile]=tilesStuff
+            if not nameTile in dicCenter:
+                if grid is None:
+                    grid=TileGrid(pathGrid)
+                    if grid.IsEmpty():
+                        with Stage('kml'): grid.Build(urlGrid)
+                try:
+                    with Stage('grid'):
+                        dicCenter.update(grid.Centers([nameTile]))
+                        dicSample[nameTile]=TileSamples(grid.Footprints([nameTile]).get(nameTile,[]))
+                except RuntimeError as msg:
+                    print("--%s"% msg)
+                    continue
+            
+            key=(strftime('%Y%m%d',dateTile),levelTile)
+            if not key in dicGroup: dicGroup[key]=[dateTile,[]]
+            dicGroup[key][1].append(tilesStuff)
+            if len(set(elem[0] for elem in dicGroup[key][1]))>=nbTileQuery or sum(len(elem[1]) for elem in dicGroup.values())>=nbQueue: Flush(key)
+            Collect()
+        
+        for key in list(dicGroup): Flush(key)
+        Collect(None,ALL_COMPLETED)
+    except Exception as msg:
+        dicCount['error']=msg
+        if stop: stop.set()
+    finally:
+        executor.shutdown(wait=True)
+        if grid: grid.Close()
+        PutStage(queueProd,None,stop)
+
+def DownloadLoop(queueProd,pool,nbSplit=1,checkMd5=False,cache=None,window=None,reduce=0,archive=None,post=None,planner=None,stop=None):
+    '''
+    Last stage: take resolved tiles from queueProd (None ends the list), 
+    download their files on the pool (nbQueue tiles at most in progress, 
+    offline ones and ones waiting for disk room aside) and return the 
+    number of tiles correctly done. Rows of the same product share files.
+    '''
+    if archive is None: archive=Archive(pool)
+    dicJob={}   # future: [file or product url (tile index for stacks), job kind]
+    dicFile={}  # file url: [downloaded path, return code (None while running), [(tile index, wanted path)], kind, MD5 checked after]
+    setStack=set() # tile index: bands stacked
+    dicRelat={} # product title: band paths from its Xml file
+    dicTile={}  # tile index: tile stuff in progress
+    dicLeft={}  # tile index: [files left, issues]
+    dicPark={}  # tile index: product url, offline
+    dicSpace={} # tile index: bytes needed, waiting for disk room
+    dicProd={}  # product url: [tiles in dicTile, file urls in dicFile]
+    dicDone={}  # file url: committed path, products without tile in progress (until the list is read)
+    
+    def Want(i,kind,repOut,fileName,url,md5=None):
+        '''
+        Tile i wants url in repOut/fileName: nothing to do if it exists, 
+        else joins the running download of url or starts it. Returns True 
+        if the file is there already.
+        '''
+        pathOut=os.path.join(repOut,fileName)
+        if os.path.exists(pathOut): return True
+        if url in dicDone and os.path.exists(dicDone[url]):
+            LinkFile(dicDone[url],pathOut)
+            return True
+        if url in dicFile and dicFile[url][1]==0:
+            LinkFile(dicFile[url][0],pathOut)
+            return True
+        
+        dicLeft[i][0]+=1
+        if url in dicFile and dicFile[url][1] is None:
+            dicFile[url][2].append((i,pathOut))
+            return False
+        
+        # checked by the post pool before being committed
+        commit=not (post and kind in ('prod','band'))
+        md5Post=None
+        if post and isinstance(md5,str): md5,md5Post=None,md5
+        if kind=='prod':
+            fut=pool.Submit(repOut,fileName,url,nbSplit,md5,kind='prod',commit=commit)
+        elif kind=='band' and (window or reduce):
+            fut=pool.SubmitWindow(repOut,fileName,url,window,reduce,commit)
+        else:
+            fut=pool.Submit(repOut,fileName,url,kind=kind,commit=commit)
+        dicJob[fut]=[url,kind]
+        dicFile[url]=[pathOut,None,[(i,pathOut)],kind,md5Post]
+        dicProd[dicTile[i][7]][1].append(url)
+        return False
+    
+    def SubmitBands(i):
+        [nameTile,dateTile,levelTile,bandsTile,outTile,titleTile,identTile,urlODTile]=dicTile[i][:8]
+        repOut=os.path.join(outTile,'%s'% titleTile)
+        for bandNum in bandsTile:
+            relatPathBand=dicRelat[titleTile]['B%02i'% bandNum]
+            nameBandOut=titleTile+'_B%02i.jp2'% bandNum
+            Want(i,'band',repOut,nameBandOut,UrlBand(urlODTile,titleTile,relatPathBand))
+    
+    def SubmitTile(i):
+        [nameTile,dateTile,levelTile,bandsTile,outTile,titleTile,identTile,urlODTile]=dicTile[i][:8]
+        if archive.Waiting(urlODTile):
+            Park(i,urlODTile)
+            return
+        if planner:
+            nbByte=planner.Need(dicTile[i])
+            if nbByte and not planner.Reserve(i,outTile,nbByte):
+                if not i in dicSpace: print("--Not enough disk room yet, tile waits : %s (%.2f GB)"% (titleTile,nbByte/1e9))
+                dicSpace[i]=nbByte
+                return
+            dicSpace.pop(i,None)
+        dicLeft[i]=[0,0]
+        
+        #Download whole product
+        if bandsTile=='prod':
+            md5=checkMd5
+            if len(dicTile[i])>8 and dicTile[i][8]: md5=dicTile[i][8]
+            if Want(i,'prod',outTile,titleTile+'.zip',urlODTile,md5): print("Product already exists : %s"% outTile)
+        
+        #Download Xml file of product, bands come later
+        else:
+            repOut=os.path.join(outTile,'%s'% titleTile)
+            os.makedirs(repOut,exist_ok=True)
+            
+            if not titleTile in dicRelat and cache: 
+                dicoRelatPath=cache.GetBands(titleTile)
+                if dicoRelatPath: dicRelat[titleTile]=dicoRelatPath
+            
+            xmlName,urlXml=UrlXml(urlODTile,titleTile,levelTile)
+            if titleTile in dicRelat:
+                SubmitBands(i)
+            elif Want(i,'xml',repOut,xmlName,urlXml):
+                # Xml file kept by a previous run
+                dicRelat[titleTile]=ReadS2XML(os.path.join(repOut,xmlName),levelTile)
+                SubmitBands(i)
+        
+        if not dicLeft[i][0]: Close(i)
+    
+    def Done(url,returnCode):
+        '''Download of url over (and checked), its file goes to each tile waiting for it'''
+        pathMain,_,lstWait,kind=dicFile[url][:4]
+        dicFile[url][1]=returnCode
+        for i,pathOut in lstWait:
+            [nameTile,dateTile,levelTile,bandsTile,outTile,titleTile,identTile,urlODTile]=dicTile[i][:8]
+            if returnCode:
+                if kind=='prod': print("--Download issue")
+                elif kind=='xml': print("--Download issue : Xml file")
+                else: print("--Download issue : Bands %s"% os.path.basename(pathOut))
+                dicLeft[i][1]+=1
+            else:
+                if not pathOut==pathMain: LinkFile(pathMain,pathOut)
+                if kind=='xml':
+                    if not titleTile in dicRelat:
+                        dicRelat[titleTile]=ReadS2XML(pathMain,levelTile)
+                        if cache: cache.PutBands(titleTile,dicRelat[titleTile])
+                    
+                    #Get bands
+                    SubmitBands(i)
+            
+            dicLeft[i][0]-=1
+            if not dicLeft[i][0]: Close(i)
+    
+    def Close(i):
+        '''Tile i has all its files: its bands are stacked if asked, else it is over'''
+        [nameTile,dateTile,levelTile,bandsTile,outTile,titleTile,identTile,urlODTile]=dicTile[i][:8]
+        repOut=os.path.join(outTile,'%s'% titleTile)
+        pathStack=os.path.join(repOut,titleTile+'_stack.tif')
+        if post and post.stack and not bandsTile=='prod' and not dicLeft[i][1] and not i in setStack and not os.path.exists(pathStack):
+            setStack.add(i)
+            dicJob[post.SubmitStack([os.path.join(repOut,titleTile+'_B%02i.jp2'% bandNum) for bandNum in bandsTile],pathStack)]=[i,'stack']
+            dicLeft[i][0]+=1
+            return
+        Finish(i)
+    
+    def Park(i,urlOD):
+        '''Set tile i aside until the archive restores urlOD, its files are looked at again then'''
+        dicPark[i]=urlOD
+        dicLeft.pop(i,None)
+        if planner: planner.Release(i,True)
+        for lstVal in dicFile.values(): lstVal[2][:]=[(j,pathOut) for j,pathOut in lstVal[2] if not j==i]
+    
+    def Finish(i):
+        nonlocal stat,done
+        done+=1
+        # share of the tiles received so far (whole list unknown while streaming)
+        pool.pourcent=100.0*done/nbTile
+        if not dicLeft[i][1]: stat+=1
+        if planner:
+            planner.Release(i,dicLeft[i][1]>0)
+            planner.Forget(dicTile[i][7])
+        
+        # downloads of the product kept while a tile needs them, then only 
+        # the committed paths for the rows still to read
+        urlODTile,titleTile=dicTile[i][7],dicTile[i][5]
+        dicProd[urlODTile][0]-=1
+        if not dicProd[urlODTile][0]:
+            for url in dicProd.pop(urlODTile)[1]:
+                if not url in dicFile or dicFile[url][1] is None: continue
+                if not dicFile[url][1] and not ended: dicDone[url]=dicFile[url][0]
+                del dicFile[url]
+            dicRelat.pop(titleTile,None)
+        del dicLeft[i], dicTile[i]
+        setStack.discard(i)
+        if pool.stats: pool.stats.dicTile.update(done=done,ok=stat)
+    
+    stat,done,nbTile=0,0,0
+    ended=False
+    while not ended or dicJob or dicPark or dicSpace:
+        # new tiles while there is room, wait for them only if nothing runs
+        while not ended and len(dicTile)-len(dicPark)-len(dicSpace)<nbQueue:
+            try:
+                tilesStuff=queueProd.get(block=not dicJob,timeout=1.0 if dicPark or stop else None)
+            except queue.Empty:
+                if stop and stop.is_set():
+                    ended=True
+                    dicDone.clear()
+                break
+            if tilesStuff is None:
+                ended=True
+                dicDone.clear()
+                break
+            
+            dicTile[nbTile]=tilesStuff
+            dicProd.setdefault(tilesStuff[7],[0,[]])[0]+=1
+            nbTile+=1
+            SubmitTile(nbTile-1)
+            if pool.stats: pool.stats.dicTile.update(row=nbTile,done=done)
+        
+        # tiles waiting for disk room, smallest first
+        if dicSpace and planner.freed:
+            planner.freed=False
+            for i in sorted(dicSpace,key=dicSpace.get): SubmitTile(i)
+        if dicSpace and ended and not dicJob and not dicPark:
+            for i in list(dicSpace):
+                print("--Not enough disk room : %s (%.2f GB)"% (dicTile[i][5],dicSpace.pop(i)/1e9))
+                dicLeft[i]=[0,1]
+                Finish(i)
+        
+        # offline products polled
+        for urlOD in archive.Due():
+            dicJob[pool.executor.submit(archive.Check,urlOD)]=[urlOD,'online']
+        
+        if not dicJob:
+            if ended and dicPark: time.sleep(1.0)
+            continue
+        setDone,_=wait(dicJob,timeout=0.2,return_when=FIRST_COMPLETED)
+        for fut in setDone:
+            url,kind=dicJob.pop(fut)
+            if kind=='online':
+                state=fut.result()
+                if state=='offline': continue
+                for i in [i for i,urlOD in dicPark.items() if urlOD==url]:
+                    del dicPark[i]
+                    if state=='online':
+                        SubmitTile(i)
+                        continue
+                    print("--Product still offline : %s"% dicTile[i][5])
+                    dicLeft[i]=[0,1]
+                    Finish(i)
+                continue
+            
+            if kind=='stack':
+                msg=fut.result()
+                if msg:
+                    print("--Post issue : %s"% msg)
+                    dicLeft[url][1]+=1
+                dicLeft[url][0]-=1
+                Finish(url)
+                continue
+            if kind=='check':
+                msg=fut.result()
+                if msg: print("--Post issue : %s"% msg)
+                Done(url,1 if msg else 0)
+                continue
+            
+            returnCode=fut.result()
+            pathMain,_,lstWait,_,md5Post=dicFile[url]
+            if returnCode==codeOffline:
+                # product in the archive, retrieval ordered by this request
+                del dicFile[url]
+                for i,pathOut in lstWait:
+                    if i in dicPark: continue
+                    [nameTile,dateTile,levelTile,bandsTile,outTile,titleTile,identTile,urlODTile]=dicTile[i][:8]
+                    print("--Product offline, restore asked : %s"% titleTile)
+                    archive.Add(urlODTile,True)
+                    Park(i,urlODTile)
+                continue
+            
+            if kind=='prod' and not returnCode and not SizePart(pathMain): returnCode=1
+            if post and not returnCode and kind in ('prod','band'):
+                # checked by the post pool first
+                dicJob[post.Submit(pathMain,kind,md5Post)]=[url,'check']
+                continue
+            Done(url,returnCode)
+    
+    return stat
+
+def RunPipeline(iterRows,pool,pathGrid,refreshGrid=False,cache=None,nbSplit=1,checkMd5=False,window=None,reduce=0,post=None,planner=None):
+    '''
+    Run the three stages on the rows of iterRows: list reading and queries 
+    in their threads, downloads in the calling one. A failed stage stops 
+    the others (shared event, no stage left waiting on a queue). Returns 
+    the row counts {'row','query','error'} (error: exception of a stage 
+    thread) and the number of tiles correctly done.
+    '''
+    queueQuery=queue.Queue(maxsize=nbQueue)
+    queueProd=queue.Queue(maxsize=nbQueue)
+    dicCount={'row': 0, 'query': 0, 'error': None}
+    archive=Archive(pool)
+    stop=threading.Event()
+    
+    threadRead=threading.Thread(target=ReadStage,args=(iterRows,queueQuery,queueProd,dicCount,cache,stop),daemon=True)
+    threadQuery=threading.Thread(target=QueryStage,args=(pool,queueQuery,queueProd,dicCount,pathGrid,refreshGrid,cache,archive,planner,stop),daemon=True)
+    threadRead.start()
+    threadQuery.start()
+    
+    try:
+        stat=DownloadLoop(queueProd,pool,nbSplit,checkMd5,cache,window,reduce,archive,post,planner,stop)
+    finally:
+        # stage threads end even if the download stage failed
+        stop.set()
+        threadRead.join()
+        threadQuery.join()
+    return dicCount,stat
+
+#----------------------------------------------------------------------------------------------------
+# Asyncio API
+#----------------------------------------------------------------------------------------------------
+class AsyncHub:
+    '''
+    Asyncio front end to embed the downloader in a service, without the 
+    script globals:
+        hub=AsyncHub(['JojoId','JojoPass'],nbJobs=8)
+        lstProduct=await hub.ResolveProducts(lstRow)      # rows as IterListTile yields
+        lstOk=await hub.Download(lstProduct,[2,3,4])      # or 'prod', None for the row bands
+        hub.Close()
+    Blocking transfers run on the download pool threads, at most nbJobs at 
+    a time on the event loop (asyncio semaphore, on top of the nbPerHost 
+    cap). Each transfer has timeout seconds. A cancelled or timed out 
+    transfer stops at the next chunk (native transport) and keeps its .part 
+    file for the next attempt. A RunStats given as stats collects the 
+    transfer statistics.
+    '''
+    def __init__(self,lstLogin,nbJobs=4,nbPerHost=2,timeout=3600,transport=None,cache=None,pathGrid=None,stats=None):
+        if transport is None: transport=TransportHttp(lstLogin)
+        self.pool=DownloadPool(transport,nbJobs,nbPerHost,stats)
+        self.archive=Archive(self.pool)
+        self.nbJobs=nbJobs
+        self.timeout=timeout
+        self.cache=cache
+        self.pathGrid=pathGrid or os.path.join(os.path.dirname(os.path.abspath(__file__)),nameGridFile)
+        self.semaphore=None
+        self.dicRunning={}   # file url: [task downloading it, waiters, downloaded path]
+    
+    async def Call(self,fct,*args):
+        '''Run fct(*args,stop=event) on the pool, within the semaphore and the timeout'''
+        if self.semaphore is None: self.semaphore=asyncio.Semaphore(self.nbJobs)
+        loop=asyncio.get_running_loop()
+        stop=threading.Event()
+        async with self.semaphore:
+            fut=loop.run_in_executor(self.pool.executor,lambda: fct(*args,stop=stop))
+            try:
+                return await asyncio.wait_for(fut,self.timeout)
+            except (asyncio.CancelledError,asyncio.TimeoutError):
+                stop.set()
+                raise
+    
+    async def Fetch(self,outFolder,fileName,url,nbSplit=1,md5=None):
+        '''
+        Download url to outFolder/fileName, rows asking the same file share 
+        one transfer (then the file is linked to their folders), cancelled 
+        when its last waiter is.
+        '''
+        pathOut=os.path.join(outFolder,fileName)
+        if not url in self.dicRunning:
+            task=asyncio.ensure_future(self.Call(self.pool.Run,outFolder,fileName,url,nbSplit,md5))
+            task.add_done_callback(lambda task: self.dicRunning.pop(url,None))
+            self.dicRunning[url]=[task,0,pathOut]
+        
+        entry=self.dicRunning[url]
+        entry[1]+=1
+        try:
+            returnCode=await asyncio.shield(entry[0])
+        finally:
+            entry[1]-=1
+            if not entry[1] and not entry[0].done(): entry[0].cancel()
+        if not returnCode and not pathOut==entry[2]: LinkFile(entry[2],pathOut)
+        return returnCode
+    
+    def Centers(self,lstTile,stop=None):
+        '''Centroides and footprint samples of the known tiles (thread side, the grid connection is opened here)'''
+        grid=TileGrid(self.pathGrid)
+        if grid.IsEmpty(): grid.Build(urlGrid)
+        dicCenter={}
+        for nameTile in set(lstTile):
+            try:
+                dicCenter.update(grid.Centers([nameTile]))
+            except RuntimeError as msg:
+                print("--%s"% msg)
+        dicSample=dict((nameTile,TileSamples(lstPoly)) for nameTile,lstPoly in grid.Footprints(list(dicCenter)).items())
+        grid.Close()
+        return dicCenter,dicSample
+    
+    async def ResolveProducts(self,lstRow):
+        '''
+        Complete rows [tile,date,level,bands,outFolder] with [title,id,url] 
+        (cache first, then grouped OpenSearch queries running together). 
+        Offline products are ordered to the archive at once. Returns the 
+        resolved rows, the others are printed and left out.
+        '''
+        lstQuery,lstOrder=[],[]
+        for tilesStuff in lstRow:
+            if len(tilesStuff)<8 and self.cache:
+                lstRes=self.cache.GetProduct(*tilesStuff[:3])
+                if lstRes: tilesStuff+=lstRes
+            if len(tilesStuff)<8: lstQuery.append(tilesStuff)
+        
+        if lstQuery:
+            dicCenter,dicSample=await self.Call(self.Centers,[tilesStuff[0] for tilesStuff in lstQuery])
+            
+            dicGroup={}
+            for tilesStuff in lstQuery:
+                [nameTile,dateTile,levelTile,bandsTile,outTile]=tilesStuff
+                if not nameTile in dicCenter: continue
+                key=(strftime('%Y%m%d',dateTile),levelTile)
+                if not key in dicGroup: dicGroup[key]=[dateTile,[]]
+                if not nameTile in dicGroup[key][1]: dicGroup[key][1].append(nameTile)
+            
+            lstKey,lstTask=[],[]
+            for key in dicGroup:
+                dateTile,lstName=dicGroup[key]
+                for j in range(0,len(lstName),nbTileQuery):
+                    lstKey.append(key)
+                    lstTask.append(self.Call(QueryGroup,self.pool,lstName[j:j+nbTileQuery],dateTile,key[1],dicCenter,dicSample))
+            
+            dicResolved={}
+            for key,result in zip(lstKey,await asyncio.gather(*lstTask,return_exceptions=True)):
+                if isinstance(result,asyncio.TimeoutError): 
+                    print("--Query timeout : %s-%s"% key)
+                    continue
+                if isinstance(result,BaseException): raise result
+                for nameTile,lstRes in result.items():
+                    dicResolved[key+(nameTile,)]=lstRes
+            
+            for tilesStuff in lstQuery:
+                [nameTile,dateTile,levelTile,bandsTile,outTile]=tilesStuff
+                key=(strftime('%Y%m%d',dateTile),levelTile,nameTile)
+                if not key in dicResolved: 
+                    print("--Tile did not find : %s-%s"% (strftime('%Y%m%d',dateTile),nameTile))
+                    continue
+                [titleTile,identTile,urlODTile,online,size]=dicResolved[key]
+                tilesStuff+=[titleTile,identTile,urlODTile]
+                if self.cache: self.cache.PutProduct(nameTile,dateTile,levelTile,tilesStuff[5:8])
+                if not online and not self.archive.Waiting(urlODTile):
+                    self.archive.Add(urlODTile)
+                    lstOrder.append(self.Call(self.archive.Send,urlODTile))
+            await asyncio.gather(*lstOrder,return_exceptions=True)
+        
+        return [tilesStuff for tilesStuff in lstRow if len(tilesStuff)>=8]
+    
+    async def Download(self,lstProduct,bands=None,nbSplit=1,checkMd5=False,window=None,reduce=0):
+        '''
+        Download resolved rows (ResolveProducts, ReadMeta4) with bands (band 
+        numbers or 'prod'), None for the bands of each row. window and reduce 
+        limit bands to some JPEG2000 tiles and levels (Jp2Window). Returns 
+        one boolean per product, True if all its files are there.
+        '''
+        return list(await asyncio.gather(*[self.DownloadProduct(tilesStuff,bands,nbSplit,checkMd5,window,reduce) for tilesStuff in lstProduct]))
+    
+    async def WaitOnline(self,urlOD):
+        '''Wait for the archive to restore urlOD, True once online'''
+        self.archive.Add(urlOD,True)
+        while True:
+            await asyncio.sleep(max(0.0,self.archive.dicWait.get(urlOD,[0,0.0])[1]-time.time()))
+            state=await self.Call(self.archive.Check,urlOD)
+            if not state=='offline': return state=='online'
+    
+    async def FetchOnline(self,outFolder,fileName,urlOD,url,nbSplit=1,md5=None):
+        '''Fetch, waiting for the archive restore first if the product of urlOD is offline'''
+        while True:
+            if self.archive.Waiting(urlOD) and not await self.WaitOnline(urlOD): return codeOffline
+            returnCode=await self.Fetch(outFolder,fileName,url,nbSplit,md5)
+            if not returnCode==codeOffline: return returnCode
+            print("--Product offline, restore asked : %s"% fileName)
+            self.archive.Add(urlOD,True)
+    
+    async def DownloadProduct(self,tilesStuff,bands=None,nbSplit=1,checkMd5=False,window=None,reduce=0):
+        [nameTile,dateTile,levelTile,bandsTile,outTile,titleTile,identTile,urlODTile]=tilesStuff[:8]
+        if bands is None: bands=bandsTile
+        try:
+            #Download whole product
+            if bands=='prod':
+                if os.path.exists(os.path.join(outTile,titleTile+'.zip')): return True
+                md5=checkMd5
+                if len(tilesStuff)>8 and tilesStuff[8]: md5=tilesStuff[8]
+                return not await self.FetchOnline(outTile,titleTile+'.zip',urlODTile,urlODTile,nbSplit,md5)
+            
+            #Download Xml file of product, then bands
+            repOut=os.path.join(outTile,'%s'% titleTile)
+            os.makedirs(repOut,exist_ok=True)
+            
+            dicoRelatPath=None
+            if self.cache: dicoRelatPath=self.cache.GetBands(titleTile)
+            if not dicoRelatPath:
+                xmlName,urlXml=UrlXml(urlODTile,titleTile,levelTile)
+                if await self.FetchOnline(repOut,xmlName,urlODTile,urlXml):
+                    print("--Download issue : Xml file")
+                    return False
+                dicoRelatPath=ReadS2XML(os.path.join(repOut,xmlName),levelTile)
+                if self.cache: self.cache.PutBands(titleTile,dicoRelatPath)
+            
+            lstTask=[]
+            for bandNum in bands:
+                nameBandOut=titleTile+'_B%02i.jp2'% bandNum
+                if os.path.exists(os.path.join(repOut,nameBandOut)): continue
+                urlBand=UrlBand(urlODTile,titleTile,dicoRelatPath['B%02i'% bandNum])
+                if window or reduce:
+                    lstTask.append(self.Call(self.pool.RunWindow,repOut,nameBandOut,urlBand,window,reduce))
+                else:
+                    lstTask.append(self.Fetch(repOut,nameBandOut,urlBand))
+            lstCode=await asyncio.gather(*lstTask,return_exceptions=True)
+            if any(isinstance(code,asyncio.TimeoutError) for code in lstCode): print("--Timeout : %s"% titleTile)
+            return not any(lstCode)
+        except asyncio.TimeoutError:
+            print("--Timeout : %s"% titleTile)
+            return False
+    
+    def Close(self):
+        self.pool.Shutdown()
+
 #==========================================================
 #main
 #----------------------------------------------------------
@@ -299,159 +2502,120 @@ if __name__ == "__main__":
         #----------------------------------------------------------------------------------------------------
         # Retrieval arguments
         #----------------------------------------------------------------------------------------------------
-        parser.add_argument('pathIn',help='Tile list OR products.meta4 (from https://scihub.copernicus.eu)')
+        parser.add_argument('pathIn',help='Tile list (- for stdin) OR products.meta4 (from https://scihub.copernicus.eu)')
+        
+        parser.add_argument('-bands',default='B02B03B04',help='Set .meta4 process downloading bands, prod for whole products (default B02B03B04)')
+        
+        parser.add_argument('-split',type=int,default=1,help='Number of parallel byte ranges per whole product, native download package only, each on a slot of -hostjobs (default 1)')
+        
+        parser.add_argument('-window',type=float,nargs=4,metavar=('LONMIN','LATMIN','LONMAX','LATMAX'),help='Download only the band tiles covering this window (WGS84 longitude/latitude, projected on each product), native download package only')
+        
+        parser.add_argument('-reduce',type=int,default=0,help='Drop the REDUCE highest resolution levels of bands (read it with the same reduce factor), native download package only (default 0)')
+        
+        parser.add_argument('-md5',action='store_true',help='Check whole products with the hub MD5 (always done with .meta4)')
+        
+        parser.add_argument('-nocache',action='store_true',help='Do not use the local catalogue of resolved products (%s)'% nameCacheFile)
+        
+        parser.add_argument('-cachettl',type=float,default=ttlCache,help='Life time of the catalogue entries in days (default %i)'% ttlCache)
+        
+        parser.add_argument('-refreshgrid',action='store_true',help='Rebuild the tile index (%s) from the ESA kml'% nameGridFile)
+        
+        parser.add_argument('-report',help='Write the run report (stage times, transfer throughputs, retries, hub latencies) to REPORT, .json or .csv')
+        
+        parser.add_argument('-progress',action='store_true',help='Print a progress line (tiles, volume, throughput) on stderr every 2 seconds')
+        
+        parser.add_argument('-dp',choices=['native','wget','curl','aria2c'],default='native',help='Download package, native in-process HTTP client or external one (the first found is used as fallback) (default native)')
+        
+        parser.add_argument('-jobs','--jobs',type=int,default=4,help='Number of simultaneous downloads (default 4)')
+        
+        parser.add_argument('-retry',type=int,default=nbRetry,help='Retries of a failed transfer, with exponential backoff or the hub Retry-After (default %i)'% nbRetry)
+        
+        parser.add_argument('-hostjobs',type=int,default=2,help='Maximum simultaneous downloads on the same host, Scihub allows 2 per account (default 2)')
+        
+        parser.add_argument('-post',type=int,default=0,help='Number of processes checking the downloaded files (MD5, zip, JPEG2000), 0 for none (default 0, CPU count with -zipcrc -cog -stack)')
+        
+        parser.add_argument('-zipcrc',action='store_true',help='Check the CRC of each member of whole products (reads the whole zip)')
         
-        parser.add_argument('-bands',default='B02B03B04',help='Set .meta4 process downloading bands (default B02B03B04)')
+        parser.add_argument('-cog',action='store_true',help='Convert downloaded bands to Cloud Optimised GeoTIFF (GDAL)')
+        
+        parser.add_argument('-stack',action='store_true',help='Stack the bands of each tile to one Cloud Optimised GeoTIFF <title>_stack.tif (GDAL)')
+        
+        parser.add_argument('-budget',type=float,help='Disk budget of the run in GB (default none, only %.0f GB kept free on each output volume)'% (sizeFreeMin/1e9))
         
         args = parser.parse_args()
         
         #----------------------------------------------------------------------------------------------------
-        #Unix special character
+        #get login ID
         #----------------------------------------------------------------------------------------------------
-        if sys.platform.startswith('linux') or sys.platform.startswith('darwin'):
-            specChar="\\$value"
-        else:
-            specChar="$value"
+        lstLogin=GetLoginId()
+        print("\n------ Hello %s ---------"% lstLogin[0])
         
         #----------------------------------------------------------------------------------------------------
         #get Download Package
         #----------------------------------------------------------------------------------------------------
-        formatDP=GetDP(dicoDP)
+        if args.dp=='native':
+            transport=TransportHttp(lstLogin)
+        elif args.window or args.reduce:
+            raise RuntimeError("Band window and reduce need the native download package")
+        else:
+            transport=TransportCmd(GetDP(dicoDP,args.dp),lstLogin)
         del dicoDP
         
-        #----------------------------------------------------------------------------------------------------
-        #get login ID
-        #----------------------------------------------------------------------------------------------------
-        lstLogin=GetLoginId()
-        print("\n------ Hello %s ---------"% lstLogin[0])
-        
         #----------------------------------------------------------------------------------------------------
         # List reading
         #----------------------------------------------------------------------------------------------------
         formIn=args.pathIn.split('.')[-1]
-        if formIn=='txt':
-            lstTiles=ReadListTile(args.pathIn)
+        if args.pathIn=='-':
+            iterRows=IterListTile(sys.stdin)
+        elif formIn=='txt':
+            fileIn=open(args.pathIn)
+            iterRows=IterListTile(fileIn)
         elif formIn=='meta4':
-            lstTiles=ReadMeta4(args.pathIn,args.band)
+            iterRows=IterMeta4(args.pathIn,'prod' if args.bands=='prod' else BandParse(args.bands))
         else:
             raise RuntimeError("Unknown list format : %s"% formIn)
-        print('-- %d Tiles -----------'% len(lstTiles))
-        lstTilesUrlLess=[elem for elem in lstTiles if len(elem)<8]
         
-        #----------------------------------------------------------------------------------------------------
-        # Get centroide
-        #----------------------------------------------------------------------------------------------------
-        if lstTilesUrlLess:
-            dicCentroide=ParseKml(urlGrid,[tile[0] for tile in lstTiles])
+        cache=None
+        if not args.nocache:
+            cache=Cache(os.path.join(os.path.dirname(os.path.abspath(__file__)),nameCacheFile),args.cachettl)
         
         #----------------------------------------------------------------------------------------------------
-        # Query Loop
+        # Pipeline: list reading -> query -> download
         #----------------------------------------------------------------------------------------------------
-        i=-1
-        for tilesStuff in lstTilesUrlLess:
-            i+=1
-            [nameTile,dateTile,levelTile,bandsTile,outTile]=tilesStuff
-            #----------------------------------------------------------------------------------------------------
-            # OpenSearch query
-            #----------------------------------------------------------------------------------------------------
-            nameQuery='QueryResults_%s-%s.xml'% (strftime('%Y%m%d',dateTile),nameTile)
-            pathQuery=os.path.join(outTile,nameQuery)
-            if os.path.exists(pathQuery): os.remove(pathQuery)
-            
-            urlCur=CreateOSQuery(urlOS,nameTile,dateTile,levelTile,dicCentroide)
-            
-            cmd=formatDP.format(USERNAME=lstLogin[0], PASSWORD=lstLogin[1], OUTFOLDER=outTile ,FILENAME=nameQuery, URI_QUERY=urlCur)
-            print("--%s: %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),cmd))
-            returnCode=os.system(cmd)
-            
-            if returnCode or not os.path.exists(pathQuery) or not os.path.getsize(pathQuery):
-                print("--Query empty : %s"% pathQuery)
-                continue
-            
-            #----------------------------------------------------------------------------------------------------
-            # Query parse
-            #----------------------------------------------------------------------------------------------------
-            title,ident,urlOD=ParseOSQuery(pathQuery,nameTile,dateTile)
-            
-            if title is None or ident is None or urlOD is None: 
-                print("--Tile did not find : %s-%s"% (strftime('%Y%m%d',dateTile),nameTile))
-                continue
-            else:
-                lstTiles[i]+=[title,ident,urlOD]
-                if os.path.exists(pathQuery) : os.remove(pathQuery)
+        post=None
+        if args.post or args.zipcrc or args.cog or args.stack:
+            post=PostPool(args.post or os.cpu_count(),args.zipcrc,args.cog,args.stack)
+        stats=RunStats() if args.report or args.progress else None
+        pool=DownloadPool(transport,args.jobs,args.hostjobs,stats,args.retry)
+        if args.progress:
+            eventEnd=threading.Event()
+            threadProgress=threading.Thread(target=ProgressLoop,args=(stats,eventEnd),daemon=True)
+            threadProgress.start()
+        
+        pathGrid=os.path.join(os.path.dirname(os.path.abspath(__file__)),nameGridFile)
+        planner=DiskPlanner(args.budget*1e9 if args.budget is not None else None)
+        dicCount,stat=RunPipeline(iterRows,pool,pathGrid,args.refreshgrid,cache,args.split,args.md5,args.window,args.reduce,post,planner)
+        if post: post.Shutdown()
+        if args.progress:
+            eventEnd.set()
+            threadProgress.join()
+        pool.Shutdown()
+        if cache: cache.Close()
+        if formIn=='txt' and not args.pathIn=='-': fileIn.close()
+        if dicCount['error']: raise dicCount['error']
+        print('-- %d Tiles, %d queried -----------'% (dicCount['row'],dicCount['query']))
+        if pool.lstFailed:
+            print('-- %d transfers failed for good:'% len(pool.lstFailed))
+            for kind,name,reason,nbAttempt in pool.lstFailed: print('    %s %s (%s, %i attempts)'% (kind,name,reason,nbAttempt))
+        if args.report:
+            stats.dicTile.update(row=dicCount['row'],ok=stat)
+            stats.Report(args.report)
+            print('-- Report : %s'% args.report)
         
-        #----------------------------------------------------------------------------------------------------
-        # Download loop
-        #----------------------------------------------------------------------------------------------------
-        pourcent=100.0/float(len([elem for elem in lstTiles if len(elem)==8]))
-        stat=0
-        i=-1
-        for tilesStuff in lstTiles:
-            if not len(tilesStuff)==8 : continue
-            [nameTile,dateTile,levelTile,bandsTile,outTile,titleTile,identTile,urlODTile]=tilesStuff
-            
-            #Download whole product
-            if bandsTile=='prod':
-                if os.path.exists(os.path.join(outTile,titleTile+'.zip')): 
-                    print("Product already exists : %s"% outTile)
-                    continue
-                
-                cmd=formatDP.format(USERNAME=lstLogin[0], PASSWORD=lstLogin[1], OUTFOLDER=outTile ,FILENAME=titleTile+'.zip', URI_QUERY=urlODTile.replace("$value",specChar))
-                print("--%s-%.2f%%: %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),i*pourcent,cmd))
-                returnCode=os.system(cmd)
-                
-                if returnCode : 
-                    print("--Download issue")
-                    continue
-                elif os.path.exists(os.path.join(outTile,titleTile+'.zip')) and os.path.getsize(os.path.join(outTile,titleTile+'.zip')): 
-                    stat+=1
-            
-            #Download bands 
-            else:
-                repOut=os.path.join(outTile,'%s'% titleTile)
-                if os.path.exists(repOut): 
-                    print("Product already exists : %s"% outTile)
-                    continue
-                os.mkdir(repOut)
-                
-                #Get Xml file of product
-                xmlName='MTD_MSIL%s.xml'% levelTile[-2:]
-                urlXml='/'.join( urlODTile.split('/')[:-1]+["Nodes('%s.SAFE')"% titleTile]+["Nodes('%s')"% xmlName]+[specChar] )
-                
-                cmd=formatDP.format(USERNAME=lstLogin[0], PASSWORD=lstLogin[1], OUTFOLDER=repOut ,FILENAME=xmlName, URI_QUERY=urlXml)
-                print("--%s-%.2f%%: %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),i*pourcent,cmd))
-                returnCode=os.system(cmd)
-                
-                if returnCode : 
-                    print("--Download issue : Xml file")
-                    continue
-                else:
-                    dicoRelatPath=ReadS2XML(os.path.join(repOut,xmlName),levelTile)
-                    
-                
-                #Get bands
-                returnCode=0
-                for bandNum in bandsTile:
-                    relatPathBand=dicoRelatPath['B%02i'% bandNum]
-                    nameBandOut=titleTile+'_B%02i.jp2'% bandNum
-                    
-                    urlBand='/'.join( urlODTile.split('/')[:-1]+["Nodes('%s.SAFE')"% titleTile]+["Nodes('%s')"% elem for elem in relatPathBand.split('/')]+[specChar] )
-                    
-                    cmd=formatDP.format(USERNAME=lstLogin[0], PASSWORD=lstLogin[1], OUTFOLDER=repOut ,FILENAME=nameBandOut, URI_QUERY=urlBand)
-                    print("--%s-%.2f%%: %s"% (strftime("%Y.%m.%dT%H:%M:%S",localtime()),i*pourcent,cmd))
-                    returnCodeCur=os.system(cmd)
-                    
-                    if returnCodeCur: 
-                        print("--Download issue : Bands %s"% nameBandOut)
-                        returnCode+=1
-                
-                if not returnCode:
-                    stat+=1
-            
         #----------------------------------------------------------------------------------------------------
         # End
         #----------------------------------------------------------------------------------------------------
-        print('%d/%d Tiles correctly done---------------'% (stat,len(lstTiles)))
+        print('%d/%d Tiles correctly done---------------'% (stat,dicCount['row']))
     
     
     #----------------------------------------------------------------------------------------------------
@@ -0,0 +1,279 @@
+#!/usr/local/bin/python3
+import os
+import argparse
+import http.server, socketserver
+import urllib.parse
+import threading
+import hashlib, zipfile, io
+import re, time, random, struct
+
+#----------------------------------------------------------------------------------------------------
+# Usage
+#----------------------------------------------------------------------------------------------------
+__version__=1.0
+parser = argparse.ArgumentParser(description='''                 Local stand-in of the Copernicus Hub
+    HTTP server answering as Scihub does to S2_Download_FromList, without
+network nor account: a synthetic military grid, OpenSearch answers, OData
+product trees and payloads. Latency, bandwidth and errors are set at will,
+it is the hub of the offline benchmark (S2_Download_Bench.py -flow).
+
+**************************************************************************
+                             Tasks:
+Python 3 - Version %.1f
+- Serve the grid kml of -tiles synthetic tiles (1 degree boxes)
+- Answer OpenSearch queries (Atom feed, paged) by tile centroide, one
+  product per tile and date
+- Serve the product trees: Nodes('...SAFE') Xml files (Samples folder),
+  bands (JPEG2000 codestreams with GMLJP2 georeference on 31TFL, tiles
+  and one tile-part per resolution level, data not decodable), whole
+  products (stored zip), Checksum and Online values, byte ranges
+- Wait -latency seconds before each answer, send at most -bandwidth bytes/s
+  per connection, answer 429/503/500 (Retry-After) to -errors of the
+  requests
+**************************************************************************
+
+'''% __version__,
+formatter_class=argparse.RawDescriptionHelpFormatter)
+
+#----------------------------------------------------------------------------------------------------
+# Hard arguments
+#----------------------------------------------------------------------------------------------------
+pathSample=os.path.join(os.path.dirname(os.path.abspath(__file__)),'Samples')
+# Payload sizes (bytes): band, whole product
+sizeBand=1<<20
+sizeProd=1<<22
+# Band frame: EPSG, upper-left pixel (m), pixel size (m), image side, codestream tile side, resolution levels
+epsgBand=32631
+originBand=[600000,5000040]
+resBand=10
+sizeImage=10980
+sizeTileJp2=1024
+nbLevelJp2=5
+# Chunk written between two bandwidth waits
+sizeChunk=1<<16
+# Status of the injected errors, Retry-After given (s)
+lstErrorStatus=[429,503,500]
+delayRetryAfter=1
+
+#----------------------------------------------------------------------------------------------------
+# Synthetic hub
+#----------------------------------------------------------------------------------------------------
+def TileNames(nb):
+    '''nb tile names shaped as the military grid ones (31TFL), all different'''
+    strLetter='ABCDEFGHJKLMNPQRSTUVWXYZ'
+    return ['%02i%s%s%s'% (1+k%60,'CDEFGHJKLMNPQRSTUVWX'[k//60%20],strLetter[k//1200%24],strLetter[k//28800%24]) for k in range(nb)]
+
+def TileBox(k):
+    '''Centroide [lon,lat] and footprint ring of the k-th tile, 1 degree boxes side by side'''
+    lon,lat=-179.5+1.2*(k%290),-59.5+1.2*(k//290%100)
+    return [lon,lat],[[lon-0.5,lat-0.5],[lon+0.5,lat-0.5],[lon+0.5,lat+0.5],[lon-0.5,lat+0.5],[lon-0.5,lat-0.5]]
+
+def Box(tbox,content):
+    return struct.pack('>I4s',8+len(content),tbox)+content
+
+def Jp2Band(filler,size):
+    '''
+    JPEG2000 band of about size bytes on the band frame: signature, header 
+    and GMLJP2 boxes, codestream main header (SIZ, COD, QCD, TLM) then 
+    nbLevelJp2+1 tile-parts per tile filled with filler bytes
+    '''
+    gml=('<gml:FeatureCollection xmlns:gml="http://www.opengis.net/gml"><gml:featureMember><gml:RectifiedGridCoverage gml:id="RGC0001">'
+        '<gml:rectifiedGridDomain><gml:RectifiedGrid dimension="2"><gml:limits><gml:GridEnvelope><gml:low>0 0</gml:low><gml:high>%i %i</gml:high></gml:GridEnvelope></gml:limits>'
+        '<gml:origin><gml:Point gml:id="P0001" srsName="urn:ogc:def:crs:EPSG::%i"><gml:pos>%i %i</gml:pos></gml:Point></gml:origin>'
+        '<gml:offsetVector srsName="urn:ogc:def:crs:EPSG::%i">%i 0</gml:offsetVector><gml:offsetVector srsName="urn:ogc:def:crs:EPSG::%i">0 -%i</gml:offsetVector>'
+        '</gml:RectifiedGrid></gml:rectifiedGridDomain></gml:RectifiedGridCoverage></gml:featureMember></gml:FeatureCollection>'
+        % (sizeImage-1,sizeImage-1,epsgBand,originBand[0],originBand[1],epsgBand,resBand,epsgBand,resBand)).encode()
+    head=Box(b'jP  ',b'\r\n\x87\n')+Box(b'ftyp',b'jp2 \x00\x00\x00\x00jp2 ')
+    head+=Box(b'jp2h',Box(b'ihdr',struct.pack('>IIHBBBB',sizeImage,sizeImage,1,15,7,0,0)))+Box(b'xml ',gml)
+    
+    nbTileSide=-(-sizeImage//sizeTileJp2)
+    nbPart=nbTileSide**2*(nbLevelJp2+1)
+    siz=struct.pack('>HHH8IHBBB',0xFF51,41,0,sizeImage,sizeImage,0,0,sizeTileJp2,sizeTileJp2,0,0,1,15,1,1)
+    cod=struct.pack('>HHBBHBBBBBB',0xFF52,12,0,0,1,0,nbLevelJp2,4,4,0,1)
+    qcd=struct.pack('>HHB',0xFF5C,3+3*nbLevelJp2+1,0x40)+bytes(3*nbLevelJp2+1)
+    sizeData=max(1,(size-len(head)-len(siz+cod+qcd)-12-6*nbPart-8)//nbPart-14)
+    tlm=struct.pack('>HHBB',0xFF55,4+6*nbPart,0,0x60)+b''.join(struct.pack('>HI',k//(nbLevelJp2+1),14+sizeData) for k in range(nbPart))
+    
+    data=(filler*(sizeData//len(filler)+1))[:sizeData]
+    lstPart=[struct.pack('>HHHIBBH',0xFF90,10,k//(nbLevelJp2+1),14+sizeData,k%(nbLevelJp2+1),nbLevelJp2+1,0xFF93)+data for k in range(nbPart)]
+    return head+struct.pack('>I4s',0,b'jp2c')+b'\xff\x4f'+siz+cod+qcd+tlm+b''.join(lstPart)+b'\xff\xd9'
+
+def Payloads(sizeBand=sizeBand,sizeProd=sizeProd):
+    '''Band (JPEG2000 codestream, Jp2Band) and whole product (stored zip) payloads'''
+    filler=bytes(random.Random(0).getrandbits(8) for k in range(1<<12))
+    band=Jp2Band(filler,sizeBand)
+    
+    fileZip=io.BytesIO()
+    with zipfile.ZipFile(fileZip,'w',zipfile.ZIP_STORED) as zipOut:
+        zipOut.writestr('MTD_MSIL1C.xml',b'<xml/>')
+        zipOut.writestr('IMG_DATA.bin',(filler*(sizeProd//len(filler)+1))[:sizeProd])
+    return band,fileZip.getvalue()
+
+class MockHub(socketserver.ThreadingMixIn,http.server.HTTPServer):
+    '''
+    Threaded HTTP server of the synthetic hub (port 0 for a free one).
+    Every product is online, counts holds the requests, bytes sent and
+    errors injected.
+    '''
+    daemon_threads=True
+    
+    def __init__(self,nbTile=1000,latency=0.0,bandwidth=0,errRate=0.0,sizeBand=sizeBand,sizeProd=sizeProd,port=0):
+        super().__init__(('127.0.0.1',port),HubHandler)
+        self.latency=latency
+        self.bandwidth=bandwidth
+        self.errRate=errRate
+        self.lstTile=TileNames(nbTile)
+        self.dicTile=dict((nameTile,TileBox(k)) for k,nameTile in enumerate(self.lstTile))
+        self.dicCenter=dict(('%.4f,%.4f'% (box[0][1],box[0][0]),nameTile) for nameTile,box in self.dicTile.items())
+        self.band,self.prod=Payloads(sizeBand,sizeProd)
+        self.md5=hashlib.md5(self.prod).hexdigest().upper()
+        self.dicXml={}
+        for level in ('L1C','L2A'):
+            with open(os.path.join(pathSample,'MTD_MSI%s.xml'% level),'rb') as fileIn: self.dicXml[level]=fileIn.read()
+        self.counts={'request': 0, 'byte': 0, 'error': 0}
+        self.lock=threading.Lock()
+        self.thread=None
+    
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i'% self.server_address[1]
+    
+    @property
+    def urlOS(self):
+        return self.url+'/apihub/search?q='
+    
+    @property
+    def urlGrid(self):
+        return [self.url+'/grid.kml']
+    
+    def Count(self,key,nb=1):
+        with self.lock:
+            self.counts[key]+=nb
+    
+    def Start(self):
+        '''Serve in a background thread'''
+        self.thread=threading.Thread(target=self.serve_forever,daemon=True)
+        self.thread.start()
+        return self
+    
+    def Stop(self):
+        self.shutdown()
+        self.server_close()
+
+class HubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+    
+    def log_message(self,*args):
+        pass
+    
+    def Send(self,status,body=b'',ctype='application/xml',dicHeader={}):
+        '''Answer body as a whole, Range requests honoured, bandwidth of the hub kept'''
+        rng=self.headers.get('Range')
+        if status==200 and rng:
+            first,last=rng.split('=')[1].split('-')
+            first,last=int(first),min(int(last) if last else len(body)-1,len(body)-1)
+            if first>=len(body):
+                self.send_response(416)
+                self.send_header('Content-Range','bytes */%i'% len(body))
+                self.send_header('Content-Length','0')
+                self.end_headers()
+                return
+            dicHeader=dict(dicHeader,**{'Content-Range': 'bytes %i-%i/%i'% (first,last,len(body))})
+            status,body=206,body[first:last+1]
+        
+        self.send_response(status)
+        self.send_header('Content-Type',ctype)
+        self.send_header('Content-Length',str(len(body)))
+        for key,val in dicHeader.items(): self.send_header(key,val)
+        self.end_headers()
+        
+        hub=self.server
+        for k in range(0,len(body),sizeChunk):
+            start=time.time()
+            self.wfile.write(body[k:k+sizeChunk])
+            if hub.bandwidth:
+                time.sleep(max(0.0,len(body[k:k+sizeChunk])/hub.bandwidth-(time.time()-start)))
+        hub.Count('byte',len(body))
+    
+    def do_GET(self):
+        hub=self.server
+        hub.Count('request')
+        path=urllib.parse.unquote(self.path)
+        if hub.latency: time.sleep(hub.latency)
+        
+        if path.endswith('.kml'): return self.Send(200,self.Kml())
+        if hub.errRate and random.random()<hub.errRate:
+            hub.Count('error')
+            return self.Send(random.choice(lstErrorStatus),dicHeader={'Retry-After': str(delayRetryAfter)})
+        if '/search?' in path: return self.Send(200,self.Search(path))
+        
+        ident=re.search(r"Products\('([^']*)'\)",path)
+        if not ident or not path.endswith('$value'): return self.Send(404,b'Not found','text/plain')
+        if path.endswith('/Checksum/Value/$value'): return self.Send(200,hub.md5.encode(),'text/plain')
+        if path.endswith('/Online/$value'): return self.Send(200,b'true','text/plain')
+        
+        lstNode=re.findall(r"Nodes\('([^']*)'\)",path)
+        if not lstNode: return self.Send(200,hub.prod,'application/octet-stream')
+        if lstNode[-1].startswith('MTD_MSI'): return self.Send(200,hub.dicXml[lstNode[-1][7:10]])
+        if lstNode[-1].endswith('.jp2'): return self.Send(200,hub.band,'application/octet-stream')
+        self.Send(404,b'Not found','text/plain')
+    
+    def Kml(self):
+        hub=self.server
+        lstPlace=['<Placemark><name>%s</name><MultiGeometry><Polygon><outerBoundaryIs><LinearRing><coordinates>%s</coordinates></LinearRing></outerBoundaryIs></Polygon><Point><coordinates>%s,%s,0</coordinates></Point></MultiGeometry></Placemark>'% (nameTile,' '.join('%s,%s,0'% tuple(point) for point in ring),center[0],center[1]) for nameTile,(center,ring) in hub.dicTile.items()]
+        return ('<?xml version="1.0" encoding="UTF-8"?><kml xmlns="http://www.opengis.net/kml/2.2"><Document><Folder>%s</Folder></Document></kml>'% ''.join(lstPlace)).encode()
+    
+    def Search(self,path):
+        '''Atom feed of the query: one product per tile intersected and date, paged by start/rows'''
+        hub=self.server
+        query=urllib.parse.parse_qs(urllib.parse.urlsplit(path.replace('+','%2B')).query)
+        text=query['q'][0]
+        start=int(query.get('start',['0'])[0])
+        rows=int(query.get('rows',['10'])[0])
+        date=re.search(r'beginposition:\[(\d{4})-(\d\d)-(\d\d)',text).groups()
+        level=re.search(r'producttype:S2MSI(\w\w)',text).group(1)
+        lstName=[hub.dicCenter.get('%.4f,%.4f'% (float(lat),float(lon))) for lat,lon in re.findall(r'Intersects\(([-\d.]+),([-\d.]+)\)',text)]
+        lstName=[nameTile for nameTile in lstName if nameTile]
+        
+        lstEntry=[]
+        for nameTile in lstName[start:start+rows]:
+            title='S2B_MSIL%s_%s%s%sT103019_N0206_R108_T%s_%s%s%sT142405'% ((level,)+date+(nameTile,)+date)
+            ident='%s-%s%s%s-%s'% ((nameTile,)+date+(level,))
+            ring=hub.dicTile[nameTile][1]
+            lstEntry.append('<entry><title>%s</title><link href="%s/odata/v1/Products(\'%s\')/$value"/><id>%s</id><date name="beginposition">%s-%s-%sT10:30:19.024Z</date><str name="size">%.2f MB</str><ondemand>false</ondemand><str name="footprint">POLYGON ((%s))</str></entry>'% (title,hub.url,ident,ident,date[0],date[1],date[2],len(hub.prod)/1048576.0,', '.join('%s %s'% tuple(point) for point in ring)))
+        return ('<?xml version="1.0" encoding="utf-8"?><feed xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" xmlns="http://www.w3.org/2005/Atom"><title>Mock hub search results</title><opensearch:totalResults>%i</opensearch:totalResults>%s</feed>'% (len(lstName),''.join(lstEntry))).encode()
+
+#==========================================================
+#main
+#----------------------------------------------------------
+if __name__ == "__main__":
+    try:
+        parser.add_argument('-port',type=int,default=8765,help='Port on localhost (default 8765)')
+        
+        parser.add_argument('-tiles',type=int,default=1000,help='Tiles of the synthetic grid (default 1000)')
+        
+        parser.add_argument('-latency',type=float,default=0.0,help='Seconds before each answer (default 0)')
+        
+        parser.add_argument('-bandwidth',type=float,default=0,help='Bytes per second per connection, 0 for no limit (default 0)')
+        
+        parser.add_argument('-errors',type=float,default=0.0,help='Share of the requests answered 429/503/500 with Retry-After (default 0)')
+        
+        args = parser.parse_args()
+        if not os.path.isdir(pathSample): raise RuntimeError("Sample folder did not find : %s"% pathSample)
+        
+        hub=MockHub(args.tiles,args.latency,args.bandwidth,args.errors,port=args.port)
+        print('-- Mock hub on %s'% hub.url)
+        print('    urlOS=%s'% hub.urlOS)
+        print('    urlGrid=%s'% hub.urlGrid)
+        try:
+            hub.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        hub.server_close()
+        print('-- %(request)i requests, %(byte)i bytes, %(error)i errors injected'% hub.counts)
+    
+    #----------------------------------------------------------------------------------------------------
+    # Exceptions
+    #----------------------------------------------------------------------------------------------------
+    except RuntimeError as msg:
+        print("\nERROR - ", msg)